@@ -0,0 +1,41 @@
+"""
+Canonical addresses.
+
+Addresses come to us in different forms: user-friendly from our config and from the price list ("EQCx..."),
+raw from emulation actions and metadata ("0:b113..." / "0:B113..."), and TON itself as "ton", "TON", "native" or None.
+Everywhere we compare or look up addresses we use the canonical form: raw address with uppercase letters,
+e.g. "0:B113A994B5024A16719F69139328EB759596C38A25F59028B146FECDC3621DFE", and NATIVE for TON.
+
+Parsing user-friendly address means base64 decoding and CRC check, and we see the same few addresses
+over and over (sender, tokens of the swap matrix, price list), so results are memoized in bounded caches.
+"""
+
+import os
+from functools import lru_cache
+
+from pytoniq_core.boc.address import Address
+
+ADDRESS_CACHE_SIZE = int(os.getenv("ADDRESS_CACHE_SIZE", "16384"))
+
+NATIVE = "ton"
+NATIVE_ALIASES = (None, "ton", "TON", "native")
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def canonical_address(address):
+    if address in NATIVE_ALIASES:
+        return NATIVE
+    if ":" in address:
+        # already raw
+        return address.upper()
+    return Address(address).to_str(is_user_friendly=False).upper()
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def parse_address(address):
+    # Address objects for building messages, they are only read, so one object per address is shared
+    return Address(address)
+
+
+def is_native(address):
+    return canonical_address(address) == NATIVE
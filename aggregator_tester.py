@@ -12,53 +12,61 @@ result in reality we will check it with tonapi emulation.
 
 
 
-import aiohttp
-import json
+import os
 import time
+import aiohttp
 SENDER_ADDRESS = "UQAPPgN25OQh3EOqqt0v_CRmScxa-_ulVwm5NESN1DO4gZzD" # Kiba.ton, a lot of TON and USDT
 
-from aggregators import get_coffe_swap_route, get_dedust_route, get_prices
-from toncenter import get_wallet_seqno, emulate, get_token_symbol, get_token_decimals, get_mc_seq_no
-from messages import build_external_message
-from pytoniq_core.boc.address import Address
-from functools import partial
+from aggregators import get_aggregators
+from prices import price_service
+from toncenter import chain_state, emulate, get_token_symbol, get_token_decimals, prefetch_token_metadata
+from messages import build_emulation_message_async, start_message_pool, close_message_pool, MESSAGE_WORKERS
+from sessions import close_sessions
+from storage import SwapWriter, STATUS_OK, STATUS_TIMEOUT, STATUS_ERROR
+from deadlines import LatencyTracker, call_with_deadline
+from pipeline import Job, Stage, Pipeline
+from addresses import canonical_address
+from metrics import METRICS_PORT, counter, histogram, serve_metrics
+
 
+def is_pton(dex_transfer):
+    return (dex_transfer["source_jetton_wallet"] == None) or (dex_transfer["destination_jetton_wallet"] == None)
 
-async def assess_emulation(emulation, sender_address, input_token, input_amount, output_token, prices, aggregator):
+
+def analyze_emulation(emulation, raw_sender_address):
     """
+    Single pass over emulation json that collects everything assess_emulation needs:
+    initial and final TON balance of the sender, what sender sent and received per asset,
+    short route descriptions (without symbols yet), assets that need symbols, and trace size/depth.
+    It is synchronous and touches every transaction, action and trace node exactly once.
+
     emulation return the following json:
     {
-        "transactions": {"hash": {"account_state_hash_before":X, "account_state_hash_after":Y }},
+        "transactions": {"hash": {"account": A, "lt": L, "account_state_before": {...}, "account_state_after": {...} }},
         "account_states" : {"hash": {"balance": X, "last_trans_lt":Y}}
         "trace": { "tx_hash": X, "children": [ {"tx_hash": Y, "children":[...]} ] },
         "actions": [{}, ...]
     }
     """
-    # first we want to get the first and last transaction on sender address
-    # lets build account->lt->state map
-    accounts = {}
     if not "transactions" in emulation:
         print("Error: no transactions in emulation", emulation)
-    for tx_hash in emulation["transactions"]:
-        transaction = emulation["transactions"][tx_hash]
-        account_address = transaction["account"]
-        if not account_address in accounts:
-            accounts[account_address] = {}
-        prev_state = transaction["account_state_before"]
-        after_state = transaction["account_state_after"]
+    # we want to know initial and final balance on sender_address, that is balance
+    # before the first and before the last transaction of the sender (ordered by lt)
+    first_lt = last_lt = None
+    initial_balance = final_balance = None
+    for transaction in emulation["transactions"].values():
+        if transaction["account"] != raw_sender_address:
+            continue
         lt = int(transaction["lt"])
-        if not lt in accounts[account_address]:
-            accounts[account_address][lt] = prev_state
-        if not lt in accounts[account_address]:
-            accounts[account_address][lt] = after_state
-    # we want to know initial and final balance on sender_address
-    # problem that sender_address is in friendly format and emulation is in raw format
-    raw_sender_address = Address(sender_address).to_str(is_user_friendly=False).upper()
-    sender_account = accounts[raw_sender_address]
+        if first_lt is None or lt < first_lt:
+            first_lt = lt
+            initial_balance = transaction["account_state_before"]["balance"]
+        if last_lt is None or lt > last_lt:
+            last_lt = lt
+            final_balance = transaction["account_state_before"]["balance"]
+    if first_lt is None:
+        raise KeyError(raw_sender_address)
 
-    initial_balance = int(sender_account[min(sender_account.keys())]["balance"])
-    final_balance = int(sender_account[max(sender_account.keys())]["balance"])
-    ton_amount_diff = final_balance - initial_balance
     # now we want to get how much jetton we sent and received
     # emulation returns actions, here we are interested in jetton_swap and jetton_transfer(for not yet parsable swaps)
     """
@@ -94,109 +102,94 @@ async def assess_emulation(emulation, sender_address, input_token, input_amount,
 
     #lets calc what we send (that means sum of amounts in dex_incoming_transfer where source is sender_address) and jetton_transfer
     # and what we received (that means sum of amounts in dex_outgoing_transfer where destination is sender_address) and jetton_transfer
-    def is_pton(dex_transfer):
-        return (dex_transfer["source_jetton_wallet"] == None) or (dex_transfer["destination_jetton_wallet"] == None)
-
     short_descriptions_out = []
     short_descriptions_in  = []
     sent_amounts = {}
     received_amounts = {}
+    assets = set()
     for action in emulation["actions"]:
-        if action["type"] == "jetton_swap":
-            if action["details"]["dex_incoming_transfer"]["source"] == raw_sender_address:
-                asset = action["details"]["dex_incoming_transfer"]["asset"]
-                other_asset = action["details"]["dex_outgoing_transfer"]["asset"]
-                if is_pton(action["details"]["dex_incoming_transfer"]):
-                    asset = "ton"
-                if not asset in sent_amounts:
-                    sent_amounts[asset] = 0
-                sent_amounts[asset] += int(action["details"]["dex_incoming_transfer"]["amount"])
-                short_descriptions_out.append(
-                    { "DEX": action['details']['dex'],
-                      "IN": action['details']['dex_incoming_transfer']['amount'],
-                      "IN_ASSET": action['details']['dex_incoming_transfer']['asset'],
-                      "IN_ASSET_SHORT": await get_token_symbol(action['details']['dex_incoming_transfer']['asset']),
-                      "OUT": action['details']['dex_outgoing_transfer']['amount'],
-                      "OUT_ASSET": action['details']['dex_outgoing_transfer']['asset'],
-                      "OUT_ASSET_SHORT": await get_token_symbol(action['details']['dex_outgoing_transfer']['asset'])
-                     })
-                #f"Swap {action['details']['dex']} {float(action['details']['dex_incoming_transfer']['amount'])/ (10 ** (await get_token_decimals(asset)))} {await get_token_symbol(asset)} -> {float(action['details']['dex_outgoing_transfer']['amount'])/ (10 ** (await get_token_decimals(other_asset)))} {await get_token_symbol(other_asset)}")
-            if action["details"]["dex_outgoing_transfer"]["destination"] == raw_sender_address:
-                asset = action["details"]["dex_outgoing_transfer"]["asset"]
-                other_asset = action["details"]["dex_incoming_transfer"]["asset"]
-                if is_pton(action["details"]["dex_outgoing_transfer"]):
-                    asset = "ton"
-                if not asset in received_amounts:
-                    received_amounts[asset] = 0
-                received_amounts[asset] += int(action["details"]["dex_outgoing_transfer"]["amount"])
-                short_descriptions_in.append(
-                    { "DEX": action['details']['dex'],
-                      "IN": action['details']['dex_incoming_transfer']['amount'],
-                      "IN_ASSET": action['details']['dex_incoming_transfer']['asset'],
-                      "IN_ASSET_SHORT": await get_token_symbol(action['details']['dex_incoming_transfer']['asset']),
-                      "OUT": action['details']['dex_outgoing_transfer']['amount'],
-                      "OUT_ASSET": action['details']['dex_outgoing_transfer']['asset'],
-                      "OUT_ASSET_SHORT": await get_token_symbol(action['details']['dex_outgoing_transfer']['asset'])
-                     })
-                #f"Swap {action['details']['dex']} {float(action['details']['dex_incoming_transfer']['amount'])/ (10 ** (await get_token_decimals(asset)))} {await get_token_symbol(asset)} -> {float(action['details']['dex_outgoing_transfer']['amount'])/ (10 ** (await get_token_decimals(other_asset)))} {await get_token_symbol(other_asset)}")
-        if action["type"] == "jetton_transfer":
-            if action["details"]["sender"] == raw_sender_address:
-                asset = action["details"]["asset"]
-                if not asset in sent_amounts:
-                    sent_amounts[asset] = 0
-                sent_amounts[asset] += int(action["details"]["amount"])
-                short_descriptions_out.append(
-                    {
-                        "DEX": "UNKNOWN",
-                        "IN": action['details']['amount'],
-                        "IN_ASSET": action['details']['asset'],
-                        "IN_ASSET_SHORT": await get_token_symbol(action['details']['asset'])
-                    }
-                )
-                #short_descriptions_out.append(f"Transfer {float(action['details']['amount'])/ (10 ** (await get_token_decimals(asset)))} {await get_token_symbol(asset)}")
-            if action["details"]["receiver"] == raw_sender_address:
-                asset = action["details"]["asset"]
-                if not asset in received_amounts:
-                    received_amounts[asset] = 0
-                received_amounts[asset] += int(action["details"]["amount"])
-                short_descriptions_in.append(
-                    {
-                        "DEX": "UNKNOWN",
-                        "OUT": action['details']['amount'],
-                        "OUT_ASSET": action['details']['asset'],
-                        "OUT_ASSET_SHORT": await get_token_symbol(action['details']['asset'])
-                    }
-                )
-                #short_descriptions_in.append(f"Transfer {float(action['details']['amount'])/ (10 ** (await get_token_decimals(asset)))} {await get_token_symbol(asset)}")
-    # lets print results
-    #print("Ton diff:", ton_amount_diff,
-    #      "Sent:", json.dumps(sent_amounts, indent=4),
-    #      "Received:", json.dumps(received_amounts, indent=4))
-
-    # lets also count total number of transactions
-    count = 0
-    max_depth = 0
-    def add_children(tx, depth):
-        nonlocal count, max_depth
-        max_depth = max(max_depth, depth)
-        count += 1
-        for child in tx.get("children", []):
-            add_children(child, depth + 1)
-    for tx in [emulation["trace"]]:
-        add_children(tx, 0)
-    # not lets make hashmap in_msg -> tx_hash
-    in_msg_to_tx = {}
-    for tx in emulation["transactions"]:
-        in_msg = emulation["transactions"][tx]["in_msg"]
-        in_msg_to_tx[in_msg["hash"]] = tx
-    # lets check if all messages from out_msg has corresponding in_msg
-    for tx in emulation["transactions"]:
-        for out_msg in emulation["transactions"][tx]["out_msgs"]:
-            if not out_msg["hash"] in in_msg_to_tx:
-                #print("Error: out_msg without in_msg", out_msg)
-                pass
-    #print("Trace_id:", emulation["trace"]["tx_hash"])
-    #print("Total transactions:", count, max_depth)
+        action_type = action["type"]
+        if action_type == "jetton_swap":
+            details = action["details"]
+            incoming = details["dex_incoming_transfer"]
+            outgoing = details["dex_outgoing_transfer"]
+            to_sender = outgoing["destination"] == raw_sender_address
+            if incoming["source"] == raw_sender_address or to_sender:
+                # symbols (*_SHORT) are filled by assess_emulation once metadata is resolved
+                description = { "DEX": details['dex'],
+                                "IN": incoming['amount'],
+                                "IN_ASSET": incoming['asset'],
+                                "IN_ASSET_SHORT": None,
+                                "OUT": outgoing['amount'],
+                                "OUT_ASSET": outgoing['asset'],
+                                "OUT_ASSET_SHORT": None
+                              }
+                assets.add(incoming["asset"])
+                assets.add(outgoing["asset"])
+            if incoming["source"] == raw_sender_address:
+                asset = "ton" if is_pton(incoming) else incoming["asset"]
+                sent_amounts[asset] = sent_amounts.get(asset, 0) + int(incoming["amount"])
+                short_descriptions_out.append(description)
+            if to_sender:
+                asset = "ton" if is_pton(outgoing) else outgoing["asset"]
+                received_amounts[asset] = received_amounts.get(asset, 0) + int(outgoing["amount"])
+                short_descriptions_in.append(dict(description))
+        elif action_type == "jetton_transfer":
+            details = action["details"]
+            asset = details["asset"]
+            if details["sender"] == raw_sender_address:
+                sent_amounts[asset] = sent_amounts.get(asset, 0) + int(details["amount"])
+                short_descriptions_out.append({ "DEX": "UNKNOWN", "IN": details['amount'], "IN_ASSET": asset, "IN_ASSET_SHORT": None })
+                assets.add(asset)
+            if details["receiver"] == raw_sender_address:
+                received_amounts[asset] = received_amounts.get(asset, 0) + int(details["amount"])
+                short_descriptions_in.append({ "DEX": "UNKNOWN", "OUT": details['amount'], "OUT_ASSET": asset, "OUT_ASSET_SHORT": None })
+                assets.add(asset)
+
+    # lets also count total number of transactions and depth of the trace, iteratively
+    trace_count = 0
+    trace_depth = 0
+    stack = [(emulation["trace"], 0)]
+    while stack:
+        tx, depth = stack.pop()
+        trace_count += 1
+        if depth > trace_depth:
+            trace_depth = depth
+        for child in tx.get("children", ()):
+            stack.append((child, depth + 1))
+
+    return {
+        "initial_balance": int(initial_balance),
+        "final_balance": int(final_balance),
+        "sent_amounts": sent_amounts,
+        "received_amounts": received_amounts,
+        "short_descriptions_out": short_descriptions_out,
+        "short_descriptions_in": short_descriptions_in,
+        "assets": assets,
+        "trace_count": trace_count,
+        "trace_depth": trace_depth,
+    }
+
+
+async def assess_emulation(emulation, sender_address, input_token, input_units, output_token, prices):
+    # input_units is input amount in minimal units (nanotons for TON), whatever units aggregator API wanted
+    # problem that sender_address is in friendly format and emulation is in raw format
+    raw_sender_address = canonical_address(sender_address)
+    analysis = analyze_emulation(emulation, raw_sender_address)
+    ton_amount_diff = analysis["final_balance"] - analysis["initial_balance"]
+    sent_amounts = analysis["sent_amounts"]
+    received_amounts = analysis["received_amounts"]
+    short_descriptions_out = analysis["short_descriptions_out"]
+    short_descriptions_in = analysis["short_descriptions_in"]
+
+    # resolve symbols of all assets from descriptions with one batched metadata request,
+    # so get_token_symbol calls below are served from cache
+    await prefetch_token_metadata(analysis["assets"])
+    for description in short_descriptions_out + short_descriptions_in:
+        if "IN_ASSET_SHORT" in description:
+            description["IN_ASSET_SHORT"] = await get_token_symbol(description["IN_ASSET"])
+        if "OUT_ASSET_SHORT" in description:
+            description["OUT_ASSET_SHORT"] = await get_token_symbol(description["OUT_ASSET"])
 
     # Now we want to calculate "price": ratio of what we received to what we sent
     # we only want to take into account target received jetton, sent jetton and TON
@@ -207,9 +200,7 @@ async def assess_emulation(emulation, sender_address, input_token, input_amount,
     gas_fee = -ton_amount_diff # Gas fees is essentially the difference in TON balance
     # If input_asset == TON, we exclude its amount from gas fees
     if input_token == "ton":
-        # swap.coffee and DeDust handles input_amount differently in terms of decimals, and
-        # we should take it into account here
-        gas_fee -= input_amount * (1 if aggregator == "dedust" else 10**9)
+        gas_fee -= input_units
     # lets calculate USD value of what we sent and received
     sent_usd = 0
     received_usd = 0
@@ -219,12 +210,13 @@ async def assess_emulation(emulation, sender_address, input_token, input_amount,
     #for asset in received_amounts:
     #    received_usd += received_amounts[asset] * prices[asset]
     # only take into account target asset
-    raw_output_token = Address(output_token).to_str(is_user_friendly=False).upper()
+    raw_output_token = canonical_address(output_token)
     received_usd = received_amounts.get(raw_output_token, 0) * prices[raw_output_token]
 
-    # lets calculate the loss ratio
+    # lets calculate the loss ratio, without anything sent there is nothing to compare with
+    # and the job is recorded as failed
     if sent_usd == 0:
-        return 0
+        raise ValueError("nothing of value was sent in emulation")
     print(short_descriptions_out)
     real_out_amount = received_amounts.get(raw_output_token, 0)
     return received_usd / sent_usd, short_descriptions_out, short_descriptions_in, real_out_amount, gas_fee / 10**9
@@ -237,98 +229,251 @@ async def assess_emulation(emulation, sender_address, input_token, input_amount,
 
 
 # lets put it all together
-async def emulate_and_assess(mc_seq_no, seqno, get_route, input_token, output_token, input_amount, prices, aggregator):
-    route = await get_route(SENDER_ADDRESS, input_token, output_token, input_amount)
-    swap_external = build_external_message(SENDER_ADDRESS, seqno, route[1])
-    swap_emulation = await emulate(mc_seq_no, swap_external)
-    emulation_assesment, out_desc, in_descr, real_out_amount, gas_fees = await assess_emulation(swap_emulation, SENDER_ADDRESS, input_token, input_amount, output_token, prices, aggregator)
-    return route[0], emulation_assesment, out_desc, in_descr, real_out_amount, gas_fees
-
-async def emulate_and_assess_all(input_token, output_token, input_amount):
-    seqno = await get_wallet_seqno(SENDER_ADDRESS)
-    tasks = []
-    in_decimals = await get_token_decimals(input_token)
-    out_decimals = await get_token_decimals(output_token)
-
-    prices = await get_prices()
-    mc_seq_no = await get_mc_seq_no()
-    tasks.append(emulate_and_assess(mc_seq_no, seqno, get_coffe_swap_route, input_token, output_token, input_amount, prices, "swap.coffee"))
-    # Fix 'output_token_decimals' argument
-    dedust_route_getter = partial(get_dedust_route, output_token_decimals=out_decimals)
-    tasks.append(emulate_and_assess(mc_seq_no, seqno, dedust_route_getter, input_token, output_token, input_amount * 10**in_decimals, prices, "dedust"))
-    results = await asyncio.gather(*tasks)
-
-    real_output_swap_coffee = results[0][4]
-    real_output_dedust = results[1][4]
-    gas_fees_swap_coffee = results[0][5]
-    gas_fees_dedust = results[1][5]
-    print("Expected Coffee.swap:", results[0][0], "DeDust:", results[1][0])
-    print("Real     Coffee.swap:", real_output_swap_coffee, "DeDust:", real_output_dedust)
-    print("Loss R   Coffee.swap:", results[0][1], "DeDust:", results[1][1])
-    print("Gas fees   Coffee.swap:", gas_fees_swap_coffee, "DeDust:", gas_fees_dedust)
+# seconds one emulation may take, including waiting for toncenter_limiter
+EMULATION_BUDGET = float(os.getenv("EMULATION_BUDGET", "30"))
+# emulations are hedged only if this is set: a hedge spends toncenter quota that other swaps are waiting for
+EMULATION_HEDGE_PERCENTILE = float(os.getenv("EMULATION_HEDGE_PERCENTILE", "0"))
+# aggregator name -> LatencyTracker of its route calls
+route_latencies = {}
+emulation_latencies = LatencyTracker()
+
+# workers of every pipeline stage, emulations are additionally paced by toncenter_limiter.
+# Route workers are per aggregator, so a hanging aggregator only blocks its own ones,
+# and the default covers the whole swap matrix, so its routes take one timeout per sweep, not several
+ROUTE_CONCURRENCY = int(os.getenv("ROUTE_CONCURRENCY", "16"))
+BUILD_CONCURRENCY = int(os.getenv("BUILD_CONCURRENCY", str(max(1, MESSAGE_WORKERS))))
+EMULATE_CONCURRENCY = int(os.getenv("EMULATE_CONCURRENCY", "8"))
+ASSESS_CONCURRENCY = int(os.getenv("ASSESS_CONCURRENCY", "4"))
+# how many jobs may wait in front of every stage
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+
+
+class SwapJob(Job):
+    """
+    One swap evaluated by one aggregator, against chain state and prices shared by the sweep
+    """
+    def __init__(self, input_token, output_token, input_amount, aggregator, seqno, mc_seq_no, price_snapshot, utime):
+        super().__init__()
+        # rows of all aggregators of one swap share utime, see swap_jobs
+        self.utime = utime
+        self.input_token = input_token
+        self.output_token = output_token
+        self.input_amount = input_amount
+        self.swap_type = f"{input_amount} {input_token}->{output_token}"
+        self.aggregator = aggregator
+        self.seqno = seqno
+        self.mc_seq_no = mc_seq_no
+        self.prices = price_snapshot.prices
+        self.price_utime = price_snapshot.utime
+        self.in_decimals = None
+        self.out_decimals = None
+        self.expected_output = None
+        self.transactions = None
+        self.external = None
+        self.emulation = None
+        self.result = None
+        # jobs of the same swap (this one included) and whether this one has left the pipeline
+        self.siblings = [self]
+        self.finished = False
+
+    def status(self):
+        if self.error is None:
+            return STATUS_OK
+        return STATUS_TIMEOUT if isinstance(self.error, asyncio.TimeoutError) else STATUS_ERROR
+
+    def row(self):
+        # row for storage.SwapWriter, failed aggregators are stored too, without measurements,
+        # so the dashboard can tell "slow" from "missing"
+        if self.error is not None:
+            return (self.utime, self.aggregator.name, self.swap_type, None, None, None, None, None, self.status(), self.price_utime)
+        loss_ratio, out_desc, in_descr, real_output, gas_fees = self.result
+        return (self.utime, self.aggregator.name, self.swap_type, real_output, loss_ratio, out_desc, in_descr, gas_fees, STATUS_OK, self.price_utime)
+
+
+def swap_jobs(input_token, output_token, input_amount, aggregators, seqno, mc_seq_no, price_snapshot):
+    """
+    Jobs of one swap, one per aggregator. Readers rank aggregators by grouping rows on utime (see api.rank_rows),
+    so utime is fixed here for all of them instead of when each one finishes
+    """
     utime = int(time.time())
-    insert_data(utime, "Coffee.swap", f"{input_amount} {input_token}->{output_token}", real_output_swap_coffee, results[0][1], results[0][2], results[0][3], gas_fees_swap_coffee)
-    insert_data(utime, "DeDust", f"{input_amount} {input_token}->{output_token}", real_output_dedust, results[1][1], results[1][2], results[1][3], gas_fees_dedust)
+    jobs = [SwapJob(input_token, output_token, input_amount, aggregator, seqno, mc_seq_no, price_snapshot, utime) for aggregator in aggregators]
+    for job in jobs:
+        job.siblings = jobs
+    return jobs
 
-    # Toncenter API key that is used doesn't support that much requests per seconds, so we wait a bit here
-    await asyncio.sleep(1)
 
-import asyncio
+async def fetch_route(job):
+    job.in_decimals = await get_token_decimals(job.input_token)
+    job.out_decimals = await get_token_decimals(job.output_token)
+    # route calls are limited by the aggregator timeout and hedged after its p95
+    job.expected_output, job.transactions = await call_with_deadline(
+        lambda: job.aggregator.get_route(SENDER_ADDRESS, job.input_token, job.output_token, job.input_amount, job.in_decimals, job.out_decimals),
+        job.aggregator.timeout, route_latencies.setdefault(job.aggregator.name, LatencyTracker()))
+
+
+async def build_message(job):
+    # CPU-bound, so it runs in the process pool of messages.py and doesn't stall the other stages
+    job.external = await build_emulation_message_async(SENDER_ADDRESS, job.seqno, job.transactions)
 
-# Now we want to get SQLITE database where store data
-# utime, aggregator, swap_type(what to what and amount), real_output, loss_ratio, short_descriptions_out, gas_fees
-# then we want to  retrieve data for prev 24 hours (so index for utime) and given swap_type
-
-def create_database_if_not_exists():
-    import sqlite3
-    conn = sqlite3.connect('aggregator.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS swaps
-                 (utime INTEGER, aggregator TEXT, swap_type TEXT, real_output REAL, loss_ratio REAL, short_descriptions_out TEXT, short_descriptions_in TEXT, gas_fees REAL)''')
-    # create indexes
-    c.execute('''CREATE INDEX IF NOT EXISTS idx_utime ON swaps (utime)''')
-    c.execute('''CREATE INDEX IF NOT EXISTS idx_swap_type ON swaps (swap_type)''')
-    conn.commit()
-    conn.close()
-
-def insert_data(utime, aggregator, swap_type, real_output, loss_ratio, short_descriptions_out, short_descriptions_in, gas_fees):
-    import sqlite3
-    conn = sqlite3.connect('aggregator.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO swaps VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (utime, aggregator, swap_type, real_output, loss_ratio, json.dumps(short_descriptions_out), json.dumps(short_descriptions_in), gas_fees))
-    # also let's automatically remove more than week old data
-    c.execute("DELETE FROM swaps WHERE utime < ?", (utime - 7 * 24 * 3600,))
-    conn.commit()
-    conn.close()
+
+async def emulate_job(job):
+    attempts = 0
+
+    def attempt():
+        nonlocal attempts
+        attempts += 1
+        # every attempt after the first one is a hedge, it must not just wait for the emulation it hedges
+        return emulate(job.mc_seq_no, job.external, hedge=attempts > 1)
+
+    job.emulation = await call_with_deadline(attempt, EMULATION_BUDGET, emulation_latencies, EMULATION_HEDGE_PERCENTILE)
+
+
+async def assess_job(job):
+    job.result = await assess_emulation(job.emulation, SENDER_ADDRESS, job.input_token, int(job.input_amount * 10**job.in_decimals),
+                                        job.output_token, job.prices)
+    # emulation json is the biggest thing job holds, we don't need it anymore
+    job.emulation = None
+
+
+def report(job):
+    if job.error is None:
+        loss_ratio, _, _, real_output, gas_fees = job.result
+        print(f"Swap {job.swap_type} {job.aggregator.name}: expected {job.expected_output} real {real_output} loss ratio {loss_ratio} gas fees {gas_fees}")
+    elif isinstance(job.error, asyncio.TimeoutError):
+        print(f"Swap {job.swap_type} {job.aggregator.name}: ran out of {job.failed_stage} budget")
+    else:
+        print(f"Swap {job.swap_type} {job.aggregator.name}: {job.failed_stage} failed: {job.error!r}")
+
+
+def build_pipeline(writer=None):
+    """
+    route fetching -> message building -> emulation -> assessment -> persistence (if writer is given)
+    """
+    async def persist(job):
+        report(job)
+        job.finished = True
+        # rows of a swap are written together once all its aggregators are done: PlacementCache reads every utime
+        # only once, so a sibling committed in a later transaction would never be ranked
+        if writer is not None and all(sibling.finished for sibling in job.siblings):
+            await writer.write([sibling.row() for sibling in job.siblings])
+
+    return Pipeline([
+        Stage("route", fetch_route, ROUTE_CONCURRENCY, PIPELINE_QUEUE_SIZE, key=lambda job: job.aggregator.name),
+        Stage("build", build_message, BUILD_CONCURRENCY, PIPELINE_QUEUE_SIZE),
+        Stage("emulate", emulate_job, EMULATE_CONCURRENCY, PIPELINE_QUEUE_SIZE),
+        Stage("assess", assess_job, ASSESS_CONCURRENCY, PIPELINE_QUEUE_SIZE),
+        Stage("persist", persist, 1, PIPELINE_QUEUE_SIZE, always=True),
+    ])
+
+
+def external_rejected(job):
+    # toncenter answered the emulation with an error status; running out of budget or quota (429) is not about the message
+    error = job.error
+    return job.failed_stage == "emulate" and isinstance(error, aiohttp.ClientResponseError) and error.status != 429
+
+
+async def emulate_and_assess_all(input_token, output_token, input_amount, seqno=None, mc_seq_no=None, price_snapshot=None, aggregators=None):
+    """
+    Evaluates one swap by all aggregators and returns rows for storage.SwapWriter
+    """
+    if seqno is None:
+        seqno = await chain_state.wallet_seqno(SENDER_ADDRESS)
+    if mc_seq_no is None:
+        mc_seq_no = await chain_state.mc_seq_no()
+    if price_snapshot is None:
+        price_snapshot = await price_service.get()
+    if aggregators is None:
+        aggregators = get_aggregators()
+    jobs = swap_jobs(input_token, output_token, input_amount, aggregators, seqno, mc_seq_no, price_snapshot)
+    await build_pipeline().run(jobs)
+    return [job.row() for job in jobs]
+
+
+# Swap matrix evaluated on every sweep: each pair with each amount
+USDT = "EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs"
+ton = "ton"
+RAFF = "EQCJbp0kBpPwPoBG-U5C-cWfP_jnksvotGfArPF50Q9Qiv9h"
+SWAP_PAIRS = [(ton, USDT), (ton, RAFF), (USDT, RAFF)]
+SWAP_AMOUNTS = [1, 100, 10000]
+# minimal time between starts of two consecutive sweeps, in seconds
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "0"))
+# rows are keyed by utime in seconds, a sweep started within the same second would overwrite the previous one
+MIN_SWEEP_INTERVAL = 1.0
+# when a whole sweep fails (outage, every aggregator or toncenter erroring), the next one waits this long,
+# doubling up to SWEEP_MAX_BACKOFF while failures go on, so we don't hammer APIs that are already down
+SWEEP_BACKOFF = float(os.getenv("SWEEP_BACKOFF", "5"))
+SWEEP_MAX_BACKOFF = float(os.getenv("SWEEP_MAX_BACKOFF", "300"))
+
+sweep_seconds = histogram("sweep_seconds", "Wall-clock time of sweeps", buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600))
+jobs_total = counter("swap_jobs_total", "Evaluated (swap, aggregator) jobs by aggregator, failed stage and status")
+
+
+def build_swap_matrix(pairs=SWAP_PAIRS, amounts=SWAP_AMOUNTS):
+    return [(input_token, output_token, amount) for input_token, output_token in pairs for amount in amounts]
+
+
+async def run_sweep(swaps, pipeline):
+    """
+    Evaluates all swaps by all aggregators through the pipeline. Wallet seqno, masterchain seqno and prices are taken once
+    per sweep, so all swaps are emulated against the same block and valued with the same prices.
+    Rows of a swap are persisted as soon as all its jobs have left the pipeline.
+    Returns (wall-clock time of the sweep in seconds, whether any job succeeded).
+    """
+    started = time.monotonic()
+    # every job of the sweep is pinned to the same block and wallet seqno, both come from chain_state cache
+    # prices come from the snapshot of price_service, refreshed in background, so there is no I/O for them here
+    try:
+        seqno, mc_seq_no, price_snapshot = await asyncio.gather(chain_state.wallet_seqno(SENDER_ADDRESS), chain_state.mc_seq_no(), price_service.get())
+    except Exception as e:
+        # nothing cached is fetched again next time, main() backs off before that
+        print("Error: failed to get chain state or prices:", repr(e))
+        return time.monotonic() - started, False
+    jobs = [job for swap in swaps for job in swap_jobs(*swap, get_aggregators(), seqno, mc_seq_no, price_snapshot)]
+    await pipeline.run(jobs)
+    failed = sum(job.error is not None for job in jobs)
+    if any(external_rejected(job) for job in jobs):
+        # the usual reason of rejected externals is seqno that moved, it is cheap to ask again
+        chain_state.refresh("wallet_seqno")
+    elapsed = time.monotonic() - started
+    sweep_seconds.observe(elapsed)
+    for job in jobs:
+        jobs_total.inc(aggregator=job.aggregator.name, stage=job.failed_stage or "", status=job.status())
+    print(f"Sweep of {len(swaps)} swaps, {len(jobs)} jobs ({failed} failed) took {elapsed:.2f}s at mc block {mc_seq_no}, "
+          f"prices from {price_snapshot.age():.0f}s ago")
+    print(pipeline.stats())
+    return elapsed, failed < len(jobs)
+
+import asyncio
 
 
 async def main():
-    create_database_if_not_exists()
-    USDT = "EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs"
-    ton = "ton"
-    RAFF = "EQCJbp0kBpPwPoBG-U5C-cWfP_jnksvotGfArPF50Q9Qiv9h"
-    delay = 5
-    while True:
-        await emulate_and_assess_all(ton, USDT, 1)
-        await asyncio.sleep(delay)
-        await emulate_and_assess_all(ton, USDT, 100)
-        await asyncio.sleep(delay)
-        await emulate_and_assess_all(ton, USDT, 10000)
-        await asyncio.sleep(delay)
-
-        await emulate_and_assess_all(ton, RAFF, 1)
-        await asyncio.sleep(delay)
-        await emulate_and_assess_all(ton, RAFF, 100)
-        await asyncio.sleep(delay)
-        await emulate_and_assess_all(ton, RAFF, 10000)
-        await asyncio.sleep(delay)
-
-        await emulate_and_assess_all(USDT, RAFF, 1)
-        await asyncio.sleep(delay)
-        await emulate_and_assess_all(USDT, RAFF, 100)
-        await asyncio.sleep(delay)
-        await emulate_and_assess_all(USDT, RAFF, 10000)
-        await asyncio.sleep(delay)
+    writer = SwapWriter()
+    await writer.start()
+    if serve_metrics():
+        print("Serving metrics on port", METRICS_PORT)
+    print("Started", await start_message_pool(), "message building workers")
+    await price_service.start()
+    pipeline = build_pipeline(writer)
+    swaps = build_swap_matrix()
+    # all sweeps share the pooled sessions from sessions.py, so connections are kept alive between swaps.
+    # There are no fixed sleeps between swaps: toncenter requests are paced by toncenter_limiter at the api key quota
+    backoff = 0
+    try:
+        while True:
+            elapsed, succeeded = await run_sweep(swaps, pipeline)
+            if succeeded:
+                backoff = 0
+            else:
+                backoff = min(SWEEP_MAX_BACKOFF, backoff * 2 or SWEEP_BACKOFF)
+                print(f"Whole sweep failed, backing off for {backoff:.0f}s")
+            interval = max(SWEEP_INTERVAL, MIN_SWEEP_INTERVAL, backoff)
+            if elapsed < interval:
+                await asyncio.sleep(interval - elapsed)
+    finally:
+        await price_service.close()
+        await writer.close()
+        await close_sessions()
+        close_message_pool()
 
 
 if __name__ == '__main__':
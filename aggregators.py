@@ -1,6 +1,8 @@
-import aiohttp
-from pytoniq_core.boc.address import Address
+import importlib
 import json
+import os
+from addresses import canonical_address
+from sessions import get_session, upstream_url
 
 """
 Coffee.swap
@@ -61,93 +63,166 @@ Response will contain:
 }
 """
 
-# we give it input token address, output token address, input amount, 
-# and get output amount and messages for emulation
-# we want to use async functions so we can ask multiple aggregators at the same time
-async def get_coffe_swap_route(SENDER_ADDRESS, input_token, output_token, input_amount):
-    if input_token == "ton":
-        input_token = "native" # coffee uses "native" instead of ton
-    if output_token == "ton":
-        output_token = "native"
-    # get route
-    route_request = {
-        "input_token": {
-            "blockchain": "ton",
-            "address": input_token
-        },
-        "output_token": {
-            "blockchain": "ton",
-            "address": output_token
-        },
-        "input_amount": input_amount,
-        "max_splits": 4,
-        "max_length": 3,
-        "pool_selector": {
-        }
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://backend.swap.coffee/v1/route", json=route_request) as response:
-            route = await response.json()
-            # get transactions
-            transactions_request = {
-                "sender_address": SENDER_ADDRESS,
-                "slippage": 0.01,
-                "paths": route["paths"]
+"""
+Every aggregator is an adapter registered in AGGREGATORS. Adapter declares how its API wants the swap:
+- amount_units: "ui" if input amount is given in whole tokens (1.5 TON), "nano" if in minimal units (1500000000)
+- native_token: how the API names TON
+and implements two calls: route() that asks for the best route and transactions() that turns
+the route into messages for emulation, plus expected_output() that reads expected output (in whole tokens) from the route.
+The tester only uses this interface, so a new aggregator is one more subclass with register_aggregator(),
+either here or in a module listed in AGGREGATOR_MODULES.
+"""
+
+# seconds we give one aggregator to answer route and transactions calls, so a slow one doesn't hold the others
+AGGREGATOR_TIMEOUT = float(os.getenv("AGGREGATOR_TIMEOUT", "20"))
+
+
+class Aggregator:
+    # name stored in database and shown on the dashboard
+    name = None
+    amount_units = "ui"
+    native_token = "native"
+    timeout = AGGREGATOR_TIMEOUT
+
+    def token(self, token):
+        return self.native_token if token == "ton" else token
+
+    def amount(self, input_amount, decimals):
+        return input_amount if self.amount_units == "ui" else int(input_amount * 10**decimals)
+
+    async def route(self, sender_address, input_token, output_token, amount):
+        raise NotImplementedError
+
+    def expected_output(self, route, output_decimals):
+        raise NotImplementedError
+
+    async def transactions(self, sender_address, route):
+        raise NotImplementedError
+
+    # we give it input token address, output token address, input amount (in whole tokens),
+    # and get expected output amount and messages for emulation
+    async def get_route(self, sender_address, input_token, output_token, input_amount, input_decimals, output_decimals):
+        route = await self.route(sender_address, self.token(input_token), self.token(output_token), self.amount(input_amount, input_decimals))
+        transactions = await self.transactions(sender_address, route)
+        return self.expected_output(route, output_decimals), transactions
+
+
+# name -> adapter
+AGGREGATORS = {}
+
+
+def register_aggregator(aggregator):
+    AGGREGATORS[aggregator.name] = aggregator
+    return aggregator
+
+
+def get_aggregators(names=None):
+    """
+    Adapters to evaluate: all registered, or only given names (AGGREGATORS_ENABLED, comma separated)
+    """
+    if names is None:
+        names = [name.strip() for name in os.getenv("AGGREGATORS_ENABLED", "").split(",") if name.strip()]
+    if not names:
+        return list(AGGREGATORS.values())
+    unknown = [name for name in names if name not in AGGREGATORS]
+    if unknown:
+        raise ValueError(f"unknown aggregators: {unknown}, registered: {list(AGGREGATORS)}")
+    return [AGGREGATORS[name] for name in names]
+
+
+class CoffeeSwap(Aggregator):
+    name = "Coffee.swap"
+    amount_units = "ui"
+    native_token = "native"  # coffee uses "native" instead of ton
+    url = upstream_url("COFFEE_URL", "https://backend.swap.coffee")
+
+    async def route(self, sender_address, input_token, output_token, amount):
+        route_request = {
+            "input_token": {
+                "blockchain": "ton",
+                "address": input_token
+            },
+            "output_token": {
+                "blockchain": "ton",
+                "address": output_token
+            },
+            "input_amount": amount,
+            "max_splits": 4,
+            "max_length": 3,
+            "pool_selector": {
             }
-        async with session.post("https://backend.swap.coffee/v2/route/transactions", json=transactions_request) as response:
-            transactions = await response.json()
-            return route["output_amount"], transactions["transactions"]
-
-
-async def get_dedust_route(SENDER_ADDRESS, input_token, output_token, input_amount, output_token_decimals):
-    if input_token == "ton":
-        input_token = "native" # dedust uses "native" instead of ton
-    if output_token == "ton":
-        output_token = "native"
-    # get route
-    quote_request = {
-      "in_minter": input_token,
-      "out_minter": output_token,
-      "amount": input_amount,
-      "swap_mode": "exact_in",
-      "protocols": [], # with empty list it will be filled with default protocols (all)
-      "only_verified_pools": True,
-      "slippage_bps": 100,
-      "max_splits": 4,
-      "max_length": 3
-    }
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://api-mainnet.dedust.io/v1/router/quote", json=quote_request) as response:
-            quote = await response.json()
-
-            swap_request = {
-                "sender_address": SENDER_ADDRESS,
-                "swap_data": {
-                  "slippage_bps": 100,
-                  "routes": quote["swap_data"]["routes"]
-                }
+        }
+        async with get_session(self.url).post(f"{self.url}/v1/route", json=route_request) as response:
+            return await response.json()
+
+    def expected_output(self, route, output_decimals):
+        return route["output_amount"]
+
+    async def transactions(self, sender_address, route):
+        transactions_request = {
+            "sender_address": sender_address,
+            "slippage": 0.01,
+            "paths": route["paths"]
+        }
+        async with get_session(self.url).post(f"{self.url}/v2/route/transactions", json=transactions_request) as response:
+            return (await response.json())["transactions"]
+
+
+class DeDust(Aggregator):
+    name = "DeDust"
+    amount_units = "nano"
+    native_token = "native"  # dedust uses "native" instead of ton
+    url = upstream_url("DEDUST_URL", "https://api-mainnet.dedust.io")
+
+    async def route(self, sender_address, input_token, output_token, amount):
+        quote_request = {
+          "in_minter": input_token,
+          "out_minter": output_token,
+          "amount": amount,
+          "swap_mode": "exact_in",
+          "protocols": [], # with empty list it will be filled with default protocols (all)
+          "only_verified_pools": True,
+          "slippage_bps": 100,
+          "max_splits": 4,
+          "max_length": 3
+        }
+        async with get_session(self.url).post(f"{self.url}/v1/router/quote", json=quote_request) as response:
+            return await response.json()
+
+    def expected_output(self, route, output_decimals):
+        return int(route["out_amount"]) / 10**output_decimals
+
+    async def transactions(self, sender_address, route):
+        swap_request = {
+            "sender_address": sender_address,
+            "swap_data": {
+              "slippage_bps": 100,
+              "routes": route["swap_data"]["routes"]
             }
-        async with session.post("https://api-mainnet.dedust.io/v1/router/swap", json=swap_request) as response:
-            transactions = await response.json()
-            ui_amount_out = int(quote["out_amount"]) / 10**output_token_decimals
-            return ui_amount_out, transactions["transactions"]
+        }
+        async with get_session(self.url).post(f"{self.url}/v1/router/swap", json=swap_request) as response:
+            return (await response.json())["transactions"]
+
+
+register_aggregator(CoffeeSwap())
+register_aggregator(DeDust())
+
+# extra adapters living outside this file, e.g. AGGREGATOR_MODULES=my_router,other_router
+for module in os.getenv("AGGREGATOR_MODULES", "").split(","):
+    if module.strip():
+        importlib.import_module(module.strip())
+
+
+XDELTA_URL = upstream_url("XDELTA_URL", "https://backend.xdelta.fi")
 
 
 # it is better to use 3rd-party service to get prices, but for now I found xdelta endpoint and will use it
 async def get_prices():
-    async with aiohttp.ClientSession() as session:
-        prices_request = {}
-        async with session.post("https://backend.xdelta.fi/api/v1/prices", json=prices_request) as response:
-            prices = await response.json()
+    prices_request = {}
+    url = f"{XDELTA_URL}/api/v1/prices"
+    async with get_session(url).post(url, json=prices_request) as response:
+        prices = await response.json()
     # convert back
     prices = prices["data"]["prices"]
-    result = {}
-    for address in prices:
-        r_address = address
-        if address == "TON":
-            r_address = "ton"
-        else:
-            r_address = Address(address).to_str(is_user_friendly=False).upper()
-        result[r_address] = prices[address]
-    return result
+    # price list has the same few hundred tokens every time, canonical_address parses each of them once
+    return {canonical_address(address): price for address, price in prices.items()}
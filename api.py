@@ -0,0 +1,99 @@
+"""
+Data behind JSON API of server.py.
+
+    GET /api/swap_types
+        [{"id": 1, "name": "1 ton->EQCx...", "input_token": "ton", "output_token": "EQCx...", "amount": 1.0}, ...]
+
+    GET /api/swaps?swap_type=<id or name>&from=<utime>&to=<utime>&bucket=<seconds>
+        from/to default to the last 24 hours. Without bucket every timepoint is returned:
+        {"swap_type": ..., "bucket": 0,
+         "aggregators": {"DeDust": {"utime": [...], "place": [...], "loss_ratio": [...], "real_output": [...], "gas_fees": [...]}}}
+        With bucket points are aggregated into buckets of given size (bucket start in "utime"):
+         "aggregators": {"DeDust": {"utime": [...], "median_loss_ratio": [...], "best": [...], "count": [...]}}
+        where "best" is how many times the aggregator took the first place inside the bucket.
+
+Timed out and failed measurements (NULL loss_ratio, see storage.py) are not returned.
+Values are arranged by columns, so weekly views don't ship tens of thousands of objects to the browser.
+"""
+
+import statistics
+
+
+def rank_rows(group, loss_ratio):
+    """
+    group is rows of one swap type at one utime, returns [(row, place)]:
+    the higher the loss ratio the better the place, equal loss ratios share the place
+    """
+    group = sorted(group, key=lambda x: -loss_ratio(x))
+    ranked = []
+    for i, x in enumerate(group):
+        place = i if i != 0 and loss_ratio(x) == loss_ratio(group[i-1]) else i + 1
+        ranked.append((x, place))
+    return ranked
+
+
+def get_swap_types(conn):
+    rows = conn.execute("""SELECT t.id, t.name, p.input_token, p.output_token, m.amount
+                           FROM swap_types t JOIN pairs p ON p.id = t.pair_id JOIN amounts m ON m.id = t.amount_id
+                           ORDER BY t.id""").fetchall()
+    return [{"id": row[0], "name": row[1], "input_token": row[2], "output_token": row[3], "amount": row[4]} for row in rows]
+
+
+def resolve_swap_type(conn, value):
+    """
+    Returns (id, name) of swap type given by id or name, None if there is no such swap type
+    """
+    if value.isdigit():
+        return conn.execute("SELECT id, name FROM swap_types WHERE id = ?", (int(value),)).fetchone()
+    return conn.execute("SELECT id, name FROM swap_types WHERE name = ?", (value,)).fetchone()
+
+
+def get_swaps_version(conn, swap_type_id, start, end):
+    """
+    (first utime, last utime, number of rows) in the range, cheap enough to answer conditional requests before building response
+    """
+    return conn.execute("""SELECT MIN(utime), MAX(utime), COUNT(*) FROM swap_results
+                           WHERE swap_type_id = ? AND utime > ? AND utime <= ? AND loss_ratio IS NOT NULL""",
+                        (swap_type_id, start, end)).fetchone()
+
+
+def get_swaps(conn, swap_type_id, start, end, bucket=0):
+    rows = conn.execute("""SELECT r.utime, a.name, r.loss_ratio, r.real_output, r.gas_fees
+                           FROM swap_results r JOIN aggregators a ON a.id = r.aggregator_id
+                           WHERE r.swap_type_id = ? AND r.utime > ? AND r.utime <= ? AND r.loss_ratio IS NOT NULL
+                           ORDER BY r.utime""", (swap_type_id, start, end)).fetchall()
+    aggregators = {}
+    # bucket start -> aggregator -> [loss ratios], [places]
+    buckets = {}
+    group = []
+
+    def flush(group):
+        for (utime, name, loss_ratio, real_output, gas_fees), place in rank_rows(group, lambda x: x[2]):
+            if bucket:
+                points = buckets.setdefault(utime - utime % bucket, {}).setdefault(name, ([], []))
+                points[0].append(loss_ratio)
+                points[1].append(place)
+                continue
+            series = aggregators.setdefault(name, {"utime": [], "place": [], "loss_ratio": [], "real_output": [], "gas_fees": []})
+            series["utime"].append(utime)
+            series["place"].append(place)
+            series["loss_ratio"].append(loss_ratio)
+            series["real_output"].append(real_output)
+            series["gas_fees"].append(gas_fees)
+
+    for row in rows:
+        if group and group[0][0] != row[0]:
+            flush(group)
+            group = []
+        group.append(row)
+    if group:
+        flush(group)
+
+    for bucket_start, names in buckets.items():
+        for name, (loss_ratios, places) in names.items():
+            series = aggregators.setdefault(name, {"utime": [], "median_loss_ratio": [], "best": [], "count": []})
+            series["utime"].append(bucket_start)
+            series["median_loss_ratio"].append(statistics.median(loss_ratios))
+            series["best"].append(places.count(1))
+            series["count"].append(len(places))
+    return {"aggregators": aggregators}
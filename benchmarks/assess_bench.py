@@ -0,0 +1,210 @@
+"""
+Micro-benchmark of assess_emulation on recorded emulateTrace responses.
+
+    python3 benchmarks/assess_bench.py emulation1.json emulation2.json ... [--iterations 200]
+
+Every file is a json body returned by /api/emulate/v1/emulateTrace for a swap from SENDER_ADDRESS.
+We compare current single-pass assessment with the previous implementation (legacy_assess_emulation below,
+which walked transactions three times, awaited get_token_symbol per field and traversed the trace recursively),
+check that both produce the same result and print assessments per second.
+Token metadata is served from in-memory cache, so no network is involved.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import toncenter
+from aggregator_tester import SENDER_ADDRESS, assess_emulation, is_pton
+from pytoniq_core.boc.address import Address
+from toncenter import get_token_symbol
+from token_cache import TokenMetadataCache
+
+
+async def legacy_assess_emulation(emulation, sender_address, input_token, input_amount, output_token, prices, aggregator):
+    accounts = {}
+    for tx_hash in emulation["transactions"]:
+        transaction = emulation["transactions"][tx_hash]
+        account_address = transaction["account"]
+        if not account_address in accounts:
+            accounts[account_address] = {}
+        prev_state = transaction["account_state_before"]
+        after_state = transaction["account_state_after"]
+        lt = int(transaction["lt"])
+        if not lt in accounts[account_address]:
+            accounts[account_address][lt] = prev_state
+        if not lt in accounts[account_address]:
+            accounts[account_address][lt] = after_state
+    raw_sender_address = Address(sender_address).to_str(is_user_friendly=False).upper()
+    sender_account = accounts[raw_sender_address]
+    initial_balance = int(sender_account[min(sender_account.keys())]["balance"])
+    final_balance = int(sender_account[max(sender_account.keys())]["balance"])
+    ton_amount_diff = final_balance - initial_balance
+
+    short_descriptions_out = []
+    short_descriptions_in  = []
+    sent_amounts = {}
+    received_amounts = {}
+    for action in emulation["actions"]:
+        if action["type"] == "jetton_swap":
+            if action["details"]["dex_incoming_transfer"]["source"] == raw_sender_address:
+                asset = action["details"]["dex_incoming_transfer"]["asset"]
+                if is_pton(action["details"]["dex_incoming_transfer"]):
+                    asset = "ton"
+                if not asset in sent_amounts:
+                    sent_amounts[asset] = 0
+                sent_amounts[asset] += int(action["details"]["dex_incoming_transfer"]["amount"])
+                short_descriptions_out.append(
+                    { "DEX": action['details']['dex'],
+                      "IN": action['details']['dex_incoming_transfer']['amount'],
+                      "IN_ASSET": action['details']['dex_incoming_transfer']['asset'],
+                      "IN_ASSET_SHORT": await get_token_symbol(action['details']['dex_incoming_transfer']['asset']),
+                      "OUT": action['details']['dex_outgoing_transfer']['amount'],
+                      "OUT_ASSET": action['details']['dex_outgoing_transfer']['asset'],
+                      "OUT_ASSET_SHORT": await get_token_symbol(action['details']['dex_outgoing_transfer']['asset'])
+                     })
+            if action["details"]["dex_outgoing_transfer"]["destination"] == raw_sender_address:
+                asset = action["details"]["dex_outgoing_transfer"]["asset"]
+                if is_pton(action["details"]["dex_outgoing_transfer"]):
+                    asset = "ton"
+                if not asset in received_amounts:
+                    received_amounts[asset] = 0
+                received_amounts[asset] += int(action["details"]["dex_outgoing_transfer"]["amount"])
+                short_descriptions_in.append(
+                    { "DEX": action['details']['dex'],
+                      "IN": action['details']['dex_incoming_transfer']['amount'],
+                      "IN_ASSET": action['details']['dex_incoming_transfer']['asset'],
+                      "IN_ASSET_SHORT": await get_token_symbol(action['details']['dex_incoming_transfer']['asset']),
+                      "OUT": action['details']['dex_outgoing_transfer']['amount'],
+                      "OUT_ASSET": action['details']['dex_outgoing_transfer']['asset'],
+                      "OUT_ASSET_SHORT": await get_token_symbol(action['details']['dex_outgoing_transfer']['asset'])
+                     })
+        if action["type"] == "jetton_transfer":
+            if action["details"]["sender"] == raw_sender_address:
+                asset = action["details"]["asset"]
+                if not asset in sent_amounts:
+                    sent_amounts[asset] = 0
+                sent_amounts[asset] += int(action["details"]["amount"])
+                short_descriptions_out.append(
+                    {
+                        "DEX": "UNKNOWN",
+                        "IN": action['details']['amount'],
+                        "IN_ASSET": action['details']['asset'],
+                        "IN_ASSET_SHORT": await get_token_symbol(action['details']['asset'])
+                    }
+                )
+            if action["details"]["receiver"] == raw_sender_address:
+                asset = action["details"]["asset"]
+                if not asset in received_amounts:
+                    received_amounts[asset] = 0
+                received_amounts[asset] += int(action["details"]["amount"])
+                short_descriptions_in.append(
+                    {
+                        "DEX": "UNKNOWN",
+                        "OUT": action['details']['amount'],
+                        "OUT_ASSET": action['details']['asset'],
+                        "OUT_ASSET_SHORT": await get_token_symbol(action['details']['asset'])
+                    }
+                )
+    count = 0
+    max_depth = 0
+    def add_children(tx, depth):
+        nonlocal count, max_depth
+        max_depth = max(max_depth, depth)
+        count += 1
+        for child in tx.get("children", []):
+            add_children(child, depth + 1)
+    add_children(emulation["trace"], 0)
+    in_msg_to_tx = {}
+    for tx in emulation["transactions"]:
+        in_msg = emulation["transactions"][tx]["in_msg"]
+        in_msg_to_tx[in_msg["hash"]] = tx
+    for tx in emulation["transactions"]:
+        for out_msg in emulation["transactions"][tx]["out_msgs"]:
+            if not out_msg["hash"] in in_msg_to_tx:
+                pass
+
+    sent_amounts["ton"] = -ton_amount_diff
+    gas_fee = -ton_amount_diff
+    if input_token == "ton":
+        gas_fee -= input_amount * (1 if aggregator == "dedust" else 10**9)
+    sent_usd = 0
+    for asset in sent_amounts:
+        sent_usd += sent_amounts[asset] * prices[asset]
+    raw_output_token = Address(output_token).to_str(is_user_friendly=False).upper()
+    received_usd = received_amounts.get(raw_output_token, 0) * prices[raw_output_token]
+    if sent_usd == 0:
+        return 0
+    real_out_amount = received_amounts.get(raw_output_token, 0)
+    return received_usd / sent_usd, short_descriptions_out, short_descriptions_in, real_out_amount, gas_fee / 10**9
+
+
+def prime_metadata_cache(emulations):
+    toncenter.token_metadata_cache = TokenMetadataCache(":memory:")
+    assets = set()
+    for emulation in emulations:
+        for action in emulation["actions"]:
+            details = action["details"]
+            for transfer in (details.get("dex_incoming_transfer"), details.get("dex_outgoing_transfer"), details):
+                if transfer and transfer.get("asset"):
+                    assets.add(transfer["asset"].upper())
+    toncenter.token_metadata_cache.put_many([(asset, "TKN", 9, False) for asset in assets])
+
+
+# 1 TON swap through swap.coffee, legacy code took amount in swap.coffee units and aggregator name
+def legacy_assess(emulation, output_token, prices):
+    return legacy_assess_emulation(emulation, SENDER_ADDRESS, "ton", 1, output_token, prices, "swap.coffee")
+
+
+def current_assess(emulation, output_token, prices):
+    return assess_emulation(emulation, SENDER_ADDRESS, "ton", 10**9, output_token, prices)
+
+
+async def measure(assess, emulations, output_token, iterations):
+    prices = defaultdict(lambda: 1.0)
+    started = time.perf_counter()
+    # assess_emulation prints route descriptions, we don't want to measure the terminal
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(iterations):
+            for emulation in emulations:
+                await assess(emulation, output_token, prices)
+    return iterations * len(emulations) / (time.perf_counter() - started)
+
+
+async def run(emulations, output_token, iterations):
+    prices = defaultdict(lambda: 1.0)
+    for emulation in emulations:
+        expected = await legacy_assess(emulation, output_token, prices)
+        with contextlib.redirect_stdout(io.StringIO()):
+            actual = await current_assess(emulation, output_token, prices)
+        assert expected == actual, (expected, actual)
+    legacy = await measure(legacy_assess, emulations, output_token, iterations)
+    current = await measure(current_assess, emulations, output_token, iterations)
+    print(f"legacy assess_emulation:  {legacy:10.1f} ops/sec")
+    print(f"single-pass assessment:   {current:10.1f} ops/sec ({current / legacy:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("emulations", nargs="+", help="recorded emulateTrace responses")
+    parser.add_argument("--output-token", default="EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    emulations = []
+    for path in args.emulations:
+        with open(path) as f:
+            emulations.append(json.load(f))
+    prime_metadata_cache(emulations)
+    asyncio.run(run(emulations, args.output_token, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
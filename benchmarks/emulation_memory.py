@@ -0,0 +1,89 @@
+"""
+Peak memory of parsing emulateTrace responses: full json parsing vs streaming pruned parsing.
+
+    python3 benchmarks/emulation_memory.py emulation1.json emulation2.json ...
+
+For every recorded response we measure tracemalloc peak while parsing it the way toncenter.emulate
+does with EMULATION_STREAMING=0 (whole body + json) and =1 (ijson from the stream, chunks of 64KiB),
+and check that analyze_emulation gives the same result for both.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aggregator_tester import SENDER_ADDRESS, analyze_emulation
+from addresses import canonical_address
+from toncenter import parse_emulation_stream
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BytesStream:
+    """
+    Minimal stand-in of aiohttp StreamReader, gives body back in chunks
+    """
+    def __init__(self, body):
+        self.body = body
+        self.offset = 0
+
+    async def read(self, n=-1):
+        if n < 0:
+            n = len(self.body) - self.offset
+        n = min(n, CHUNK_SIZE)
+        chunk = self.body[self.offset:self.offset + n]
+        self.offset += len(chunk)
+        return chunk
+
+
+async def parse_full(body):
+    # response.json() reads the whole body and decodes it
+    stream = BytesStream(body)
+    chunks = []
+    while True:
+        chunk = await stream.read()
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b"".join(chunks).decode("utf-8"))
+
+
+async def parse_streaming(body):
+    return await parse_emulation_stream(BytesStream(body))
+
+
+def measure(parse, body):
+    tracemalloc.start()
+    started = time.perf_counter()
+    emulation = asyncio.run(parse(body))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return emulation, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("emulations", nargs="+", help="recorded emulateTrace responses")
+    args = parser.parse_args()
+    raw_sender_address = canonical_address(SENDER_ADDRESS)
+    for path in args.emulations:
+        with open(path, "rb") as f:
+            body = f.read()
+        full, full_peak, full_time = measure(parse_full, body)
+        pruned, pruned_peak, pruned_time = measure(parse_streaming, body)
+        assert analyze_emulation(full, raw_sender_address) == analyze_emulation(pruned, raw_sender_address)
+        print(f"{path}: body {len(body) / 1024:.0f} KiB, "
+              f"full {full_peak / 1024:.0f} KiB peak in {full_time * 1000:.1f} ms, "
+              f"streaming {pruned_peak / 1024:.0f} KiB peak in {pruned_time * 1000:.1f} ms "
+              f"({full_peak / pruned_peak:.1f}x less memory)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Micro-benchmarks of the CPU hot paths on synthetic inputs.
+
+    python3 benchmarks/hot_paths.py                              # everything, 1 and 7 day databases
+    python3 benchmarks/hot_paths.py --days 1,7,30 --db-dir /tmp/bench
+    python3 benchmarks/hot_paths.py --filter assess --save before.json
+    python3 benchmarks/hot_paths.py --filter assess --compare before.json
+
+Cases:
+    analyze_emulation / assess_emulation   synthetic traces of growing size (see synthetic.py)
+    build_external_message / build_emulation_message   external messages with 1 and 4 transfers
+    convert_route                          route descriptions of the dashboard hover text
+    dashboard / api_swaps                  cold PlacementCache render and bucketed /api/swaps on seeded databases
+
+For every case we report ops/sec of the fastest of 5 rounds within --time seconds, and memory of one call under tracemalloc:
+peak allocated during the call and what is still allocated after it returns. With --compare, cases that became
+slower or allocate more than --threshold are marked.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import toncenter
+from addresses import canonical_address
+from aggregator_tester import analyze_emulation, assess_emulation
+from api import get_swaps
+from messages import build_external_message, build_emulation_message
+from server import PlacementCache, convert_route
+from token_cache import TokenMetadataCache
+from loop_stall import synthetic_transactions
+from synthetic import SENDER_ADDRESS, USDT, EmulationGenerator, emulation_assets, seeded_database
+
+# name -> arguments of EmulationGenerator.emulation
+EMULATIONS = {
+    "small": dict(transactions=100, depth=4, splits=1, hops=1, actions=10),
+    "medium": dict(transactions=300, depth=6, splits=2, hops=2, actions=50),
+    "large": dict(transactions=2000, depth=16, splits=4, hops=3, actions=300),
+}
+ROUNDS = 5
+
+
+def measure(call, min_time, rounds=ROUNDS):
+    """
+    Returns (ops/sec, peak bytes of one call, bytes still allocated after one call).
+    Time is split into rounds and the fastest round counts, like timeit does, so noise of other processes mostly stays out.
+    """
+    call()
+    best = 0
+    for _ in range(rounds):
+        calls = 0
+        started = time.perf_counter()
+        while True:
+            call()
+            calls += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_time / rounds:
+                break
+        best = max(best, calls / elapsed)
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = call()
+        current, peak = tracemalloc.get_traced_memory()
+        # the result itself is what the caller keeps, it is counted as kept
+        del result
+    finally:
+        tracemalloc.stop()
+    return best, peak - before, current - before
+
+
+def emulation_cases():
+    loop = asyncio.new_event_loop()
+    sender = canonical_address(SENDER_ADDRESS)
+    # symbols come from in-memory cache and every asset has a price, no network involved
+    toncenter.token_metadata_cache = TokenMetadataCache(":memory:")
+    for name, kwargs in EMULATIONS.items():
+        emulation = EmulationGenerator(seed=len(name)).emulation(**kwargs)
+        assets = emulation_assets(emulation)
+        toncenter.token_metadata_cache.put_many([(asset, "TKN", 9, False) for asset in assets])
+        prices = dict.fromkeys(assets | {"ton"}, 1e-9)
+
+        def assess(emulation=emulation, prices=prices):
+            return loop.run_until_complete(assess_emulation(emulation, SENDER_ADDRESS, "ton", 10**9, USDT, prices))
+
+        label = f"{name}: {len(emulation['transactions'])} tx, {len(emulation['actions'])} actions"
+        yield f"analyze_emulation {label}", lambda emulation=emulation: analyze_emulation(emulation, sender)
+        yield f"assess_emulation {label}", assess
+
+
+def message_cases():
+    valid_until = int(time.time()) + 60
+    for count in (1, 4):
+        transactions = synthetic_transactions(count)
+        yield f"build_external_message {count} transfers", lambda transactions=transactions: build_external_message(SENDER_ADDRESS, 1, transactions, valid_until)
+        yield f"build_emulation_message {count} transfers", lambda transactions=transactions: build_emulation_message(SENDER_ADDRESS, 1, transactions, valid_until)
+
+
+def route_cases():
+    generator = EmulationGenerator(seed=1)
+    for splits in (1, 4, 16):
+        # what assess_emulation stores and the dashboard parses back
+        routes = json.dumps([{"DEX": "stonfi_v2", "IN": str(generator.rng.randint(1, 10**12)), "IN_ASSET": generator.account(),
+                              "IN_ASSET_SHORT": "TON", "OUT": "1", "OUT_ASSET": generator.account(), "OUT_ASSET_SHORT": "USD₮"}
+                             for _ in range(splits)])
+        yield f"convert_route {splits} splits", lambda routes=routes: convert_route(json.loads(routes))
+
+
+def database_cases(directory, days, selected):
+    for day_count in days:
+        names = (f"dashboard cold render, {day_count}d database", f"api_swaps hourly buckets, {day_count}d database")
+        if not any(selected in name for name in names):
+            # seeding 30 days takes a while, don't do it for nothing
+            continue
+        conn = sqlite3.connect(seeded_database(directory, day_count))
+        end = int(time.time())
+        yield names[0], lambda conn=conn: PlacementCache().render(conn)
+        yield names[1], lambda conn=conn, day_count=day_count: get_swaps(conn, 1, end - day_count * 24 * 3600, end, bucket=3600)
+
+
+def report(name, ops, peak, kept, baseline, threshold):
+    line = f"{name:<58} {ops:12.1f} ops/sec {peak / 1024:10.1f} KiB peak {kept / 1024:9.1f} KiB kept"
+    if baseline is not None and name in baseline:
+        old_ops, old_peak, _ = baseline[name]
+        regressed = ops < old_ops / (1 + threshold) or peak > old_peak * (1 + threshold)
+        line += f"   {ops / old_ops:5.2f}x speed, {peak / max(old_peak, 1):5.2f}x peak" + ("  REGRESSION" if regressed else "")
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--time", type=float, default=1.0, help="minimal seconds per case")
+    parser.add_argument("--days", default="1,7", help="seeded databases, e.g. 1,7,30")
+    parser.add_argument("--db-dir", help="keep seeded databases here between runs")
+    parser.add_argument("--filter", default="", help="only cases containing this text")
+    parser.add_argument("--save", help="write results to json")
+    parser.add_argument("--compare", help="results json of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change reported as regression")
+    args = parser.parse_args()
+    days = [int(value) for value in args.days.split(",") if value.strip()]
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        cases = [emulation_cases(), message_cases(), route_cases(), database_cases(args.db_dir or directory, days, args.filter)]
+        for group in cases:
+            for name, call in group:
+                if args.filter not in name:
+                    continue
+                # assess_emulation prints route descriptions, we don't want to measure the terminal
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results[name] = measure(call, args.time)
+                report(name, *results[name], baseline, args.threshold)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Load test of server.py.
+
+    python3 benchmarks/loadtest.py --seed aggregator.db --days 1     # fill database with synthetic sweeps
+    SERVER_PORT=8000 python3 server.py                                # in another terminal
+    python3 benchmarks/loadtest.py --url http://127.0.0.1:8000/ --requests 500 --concurrency 16
+
+Reports requests/sec and latency percentiles of the given url.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from synthetic import seed_database
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_load(url, requests, concurrency, headers=None):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {})) as response:
+                    response.read()
+                failed = False
+            except (urllib.error.URLError, OSError):
+                failed = True
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors += failed
+
+    # first request fills server caches, it is reported separately
+    started = time.perf_counter()
+    with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {})) as response:
+        response.read()
+    print(f"warm-up request: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.perf_counter() - started
+    print(f"{requests} requests, concurrency {concurrency}, {errors} errors")
+    print(f"throughput: {requests / total:.1f} requests/sec")
+    print(f"latency: p50 {percentile(latencies, 50) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", metavar="DB", help="fill given database with synthetic sweeps and exit")
+    parser.add_argument("--days", type=float, default=1)
+    parser.add_argument("--url", default="http://127.0.0.1:8000/")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--gzip", action="store_true", help="send Accept-Encoding: gzip")
+    args = parser.parse_args()
+    if args.seed:
+        print("Seeded", seed_database(args.seed, args.days), "rows into", args.seed)
+        return
+    run_load(args.url, args.requests, args.concurrency, {"Accept-Encoding": "gzip"} if args.gzip else None)
+
+
+if __name__ == "__main__":
+    main()
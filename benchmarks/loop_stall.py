@@ -0,0 +1,102 @@
+"""
+Event-loop stall while building external messages.
+
+    python3 benchmarks/loop_stall.py --messages 300 --concurrency 16
+
+Builds the same synthetic swap messages (jetton transfers with forward payload) once inline on the event loop
+and once through the process pool of messages.py. Meanwhile a probe task sleeps 1 ms in a loop and
+records how late it wakes up: that is how long any network callback of the tester would have waited.
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pytoniq_core import Address, begin_cell
+
+import messages
+from messages import build_emulation_message, build_emulation_message_async, start_message_pool, close_message_pool
+
+SENDER_ADDRESS = "UQAPPgN25OQh3EOqqt0v_CRmScxa-_ulVwm5NESN1DO4gZzD"
+USDT = "EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs"
+PROBE_INTERVAL = 0.001
+
+
+def synthetic_transactions(count):
+    # jetton transfer with forward payload, roughly what aggregators return
+    forward_payload = begin_cell().store_uint(0x6664de2a, 32).store_address(Address(USDT)).store_coins(1).end_cell()
+    payload = begin_cell().store_uint(0xf8a7ea5, 32).store_uint(1, 64).store_coins(10**9).store_address(Address(SENDER_ADDRESS)) \
+        .store_address(Address(SENDER_ADDRESS)).store_bit(0).store_coins(3 * 10**8).store_maybe_ref(forward_payload).end_cell()
+    cell = base64.b64encode(payload.to_boc()).decode()
+    return [{"address": USDT, "value": str(4 * 10**8), "cell": cell, "send_mode": 3} for _ in range(count)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def measure(build, count, concurrency, transactions):
+    lags = []
+    running = True
+
+    async def probe():
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(PROBE_INTERVAL)
+            lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(seqno):
+        async with semaphore:
+            return await build(SENDER_ADDRESS, seqno, transactions)
+
+    probe_task = asyncio.create_task(probe())
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    results = await asyncio.gather(*[one(seqno) for seqno in range(1, count + 1)])
+    elapsed = time.perf_counter() - started
+    running = False
+    await probe_task
+    return results, elapsed, lags
+
+
+def report(name, count, elapsed, lags):
+    # time the loop was blocked beyond the probe interval, summed up
+    stalled = sum(lags)
+    print(f"{name:>7}: {count / elapsed:8.1f} messages/sec, loop stalled {stalled * 1000:8.1f} ms "
+          f"({stalled / elapsed:.0%} of the run), probe lag p99 {percentile(lags, 99) * 1000:6.2f} ms, max {max(lags) * 1000:6.2f} ms")
+
+
+async def inline_build(sender_address, seqno, transactions):
+    return build_emulation_message(sender_address, seqno, transactions)
+
+
+async def run(count, concurrency, transactions_per_message):
+    transactions = synthetic_transactions(transactions_per_message)
+    print(f"{messages.MESSAGE_WORKERS} workers, {count} messages of {transactions_per_message} transactions, concurrency {concurrency}")
+    _, elapsed, lags = await measure(inline_build, count, concurrency, transactions)
+    report("inline", count, elapsed, lags)
+    await start_message_pool()
+    _, elapsed, lags = await measure(build_emulation_message_async, count, concurrency, transactions)
+    report("pool", count, elapsed, lags)
+    close_message_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--transactions", type=int, default=3, help="internal messages per external message")
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.concurrency, args.transactions))
+
+
+if __name__ == "__main__":
+    main()
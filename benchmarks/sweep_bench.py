@@ -0,0 +1,117 @@
+"""
+Full-sweep throughput and latency against recorded upstream responses.
+
+    python3 benchmarks/sweep_bench.py --record recordings.jsonl --sweeps 1      # live, with TONCENTER_API_KEY
+    python3 benchmarks/sweep_bench.py recordings.jsonl --sweeps 5 --latency 0.2 --jitter 0.1 --error-rate 0.02
+
+The first form runs sweeps against the real APIs and records every response. The second one starts replay.py
+in-process and runs the swap matrix of aggregator_tester through emulate_and_assess_all, all swaps concurrently,
+the same way every sweep: no network, no api keys, and with the same --seed the same injected latencies and faults.
+Reports sweep time, jobs/sec, latency percentiles of emulate_and_assess_all and row statuses.
+Toncenter quota is lifted (TONCENTER_RPS=1000) unless set, so the limiter doesn't hide the rest of the tester.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from replay import REPLAY_HOST, REPLAY_PORT, add_fault_arguments, server_from_arguments
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(args, server):
+    # imported here: upstream urls, quotas and caches are read from the environment set up by main()
+    import aggregator_tester as tester
+    from messages import start_message_pool, close_message_pool
+    from prices import price_service
+    from sessions import close_sessions
+    from toncenter import emulation_cache_lookups
+
+    if server is not None:
+        await server.start(args.host, args.port)
+    await start_message_pool()
+    swaps = tester.build_swap_matrix()
+    latencies = []
+    statuses = Counter()
+
+    async def timed(swap):
+        started = time.perf_counter()
+        rows = await tester.emulate_and_assess_all(*swap)
+        latencies.append(time.perf_counter() - started)
+        statuses.update(row[8] for row in rows)
+
+    try:
+        await price_service.start()
+        for sweep in range(args.warmup + args.sweeps):
+            if sweep == args.warmup:
+                latencies.clear()
+                statuses.clear()
+                measured = time.perf_counter()
+            started = time.perf_counter()
+            # per-job reports of the pipeline are noise here
+            output = sys.stdout if args.verbose else io.StringIO()
+            with contextlib.redirect_stdout(output):
+                await asyncio.gather(*[timed(swap) for swap in swaps])
+            kind = "warm-up" if sweep < args.warmup else "sweep"
+            print(f"{kind} {sweep + 1}: {len(swaps)} swaps in {time.perf_counter() - started:.2f}s")
+        elapsed = time.perf_counter() - measured
+    finally:
+        await price_service.close()
+        await close_sessions()
+        close_message_pool()
+        if server is not None:
+            await server.close()
+
+    jobs = sum(statuses.values())
+    print(f"{args.sweeps} sweeps, {jobs} jobs in {elapsed:.2f}s: {args.sweeps / elapsed:.2f} sweeps/sec, {jobs / elapsed:.1f} jobs/sec")
+    print(f"emulate_and_assess_all latency: p50 {percentile(latencies, 50):.3f}s p95 {percentile(latencies, 95):.3f}s "
+          f"p99 {percentile(latencies, 99):.3f}s max {max(latencies):.3f}s")
+    print("rows:", dict(statuses))
+    print("emulation cache, warm-up included:", {dict(labels)["result"]: value for _, labels, value in emulation_cache_lookups.samples()})
+    if server is not None:
+        print("replay:", dict(server.stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="?", help="jsonl file written with HTTP_RECORD_PATH")
+    parser.add_argument("--record", metavar="PATH", help="run against the real APIs and append responses to PATH")
+    parser.add_argument("--sweeps", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1, help="sweeps before measuring, they fill token metadata cache")
+    parser.add_argument("--host", default=REPLAY_HOST)
+    parser.add_argument("--port", type=int, default=REPLAY_PORT)
+    parser.add_argument("--verbose", action="store_true", help="keep per-job output of the pipeline")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+    if args.sweeps < 1 or bool(args.recordings) == bool(args.record):
+        parser.error("give either recordings to replay or --record PATH, and at least one sweep")
+
+    server = None
+    if args.record:
+        os.environ["HTTP_RECORD_PATH"] = args.record
+    else:
+        server = server_from_arguments(args)
+        os.environ["REPLAY_URL"] = f"http://{args.host}:{args.port}"
+        os.environ.setdefault("TONCENTER_RPS", "1000")
+        os.environ.setdefault("TONCENTER_BURST", "100")
+    with tempfile.TemporaryDirectory() as directory:
+        # every run starts with empty token metadata cache
+        os.environ.setdefault("TOKEN_CACHE_PATH", os.path.join(directory, "token_metadata.db"))
+        asyncio.run(run(args, server))
+
+
+if __name__ == "__main__":
+    main()
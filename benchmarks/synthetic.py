@@ -0,0 +1,254 @@
+"""
+Synthetic inputs for benchmarks: emulateTrace responses and seeded aggregator databases.
+
+    python3 benchmarks/synthetic.py emulation big.json --transactions 1000 --depth 12 --splits 4 --mix jetton_swap=3,pton_swap=1,jetton_transfer=1
+    python3 benchmarks/synthetic.py database week.db --days 7
+
+Emulations have the shape toncenter returns for a swap from SENDER_ADDRESS: transactions with balances and messages,
+a trace tree of the given depth, route legs of every split (sender -> pool -> ... -> pool -> sender) as jetton_swap actions,
+and extra actions of other users drawn from the mix. The files work with assess_bench.py and emulation_memory.py.
+Everything is generated from a seed, so the same arguments give the same bytes.
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from addresses import canonical_address
+from storage import SchemaIds, create_database_if_not_exists
+
+SENDER_ADDRESS = "UQAPPgN25OQh3EOqqt0v_CRmScxa-_ulVwm5NESN1DO4gZzD"
+USDT = "EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs"
+RAFF = "EQCJbp0kBpPwPoBG-U5C-cWfP_jnksvotGfArPF50Q9Qiv9h"
+SWAP_TYPES = [(input_token, output_token, amount) for input_token, output_token in [("ton", USDT), ("ton", RAFF), (USDT, RAFF)] for amount in (1, 100, 10000)]
+AGGREGATORS = ["Coffee.swap", "DeDust"]
+DEXES = ["stonfi_v2", "stonfi", "dedust", "tonco"]
+# extra actions: swaps and transfers of other users, and actions assessment doesn't look into
+DEFAULT_MIX = "jetton_swap=3,pton_swap=1,jetton_transfer=2,call_contract=1"
+# databases of benchmarks/hot_paths.py are seeded again after this many seconds
+SEED_MAX_AGE = 3600
+
+
+def parse_mix(value):
+    # "jetton_swap=3,jetton_transfer=1" -> {"jetton_swap": 3.0, "jetton_transfer": 1.0}
+    mix = {}
+    for item in value.split(","):
+        if item.strip():
+            kind, weight = item.split("=")
+            mix[kind.strip()] = float(weight)
+    return mix
+
+
+class EmulationGenerator:
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+
+    def account(self):
+        return "0:" + "%064X" % self.rng.getrandbits(256)
+
+    def tx_hash(self):
+        return "%064x" % self.rng.getrandbits(256)
+
+    def transfer(self, asset, source, destination, amount, pton=False):
+        # pTON legs are TON proxied as jetton, they have no jetton wallet on the TON side
+        return {
+            "asset": None if pton else asset,
+            "source": source,
+            "destination": destination,
+            "source_jetton_wallet": None if pton else self.account(),
+            "destination_jetton_wallet": self.account(),
+            "amount": str(amount),
+        }
+
+    def swap(self, dex, incoming, outgoing):
+        return {"success": True, "type": "jetton_swap",
+                "details": {"dex": dex, "dex_incoming_transfer": incoming, "dex_outgoing_transfer": outgoing, "peer_swaps": []}}
+
+    def jetton_transfer(self, asset, sender, receiver, amount):
+        return {"success": True, "type": "jetton_transfer",
+                "details": {"asset": asset, "sender": sender, "receiver": receiver, "amount": str(amount),
+                            "sender_jetton_wallet": self.account(), "receiver_jetton_wallet": self.account()}}
+
+    def route_actions(self, sender, input_asset, output_asset, input_units, splits, hops):
+        # every split is a chain of `hops` pools, the amount is divided evenly between splits
+        actions = []
+        for split in range(splits):
+            amount = input_units // splits
+            assets = [input_asset] + [self.account() for _ in range(hops - 1)] + [output_asset]
+            source = sender
+            for hop in range(hops):
+                pool = self.account()
+                out_amount = amount * self.rng.randint(90, 110) // 100
+                destination = sender if hop == hops - 1 else self.account()
+                incoming = self.transfer(assets[hop], source, pool, amount, pton=assets[hop] is None)
+                outgoing = self.transfer(assets[hop + 1], pool, destination, out_amount, pton=assets[hop + 1] is None)
+                actions.append(self.swap(self.rng.choice(DEXES), incoming, outgoing))
+                source, amount = pool, out_amount
+        return actions
+
+    def extra_action(self, kind, sender, input_asset):
+        amount = self.rng.randint(10**6, 10**12)
+        if kind == "jetton_swap":
+            return self.swap(self.rng.choice(DEXES), self.transfer(self.account(), self.account(), self.account(), amount),
+                             self.transfer(self.account(), self.account(), self.account(), amount))
+        if kind == "pton_swap":
+            return self.swap(self.rng.choice(DEXES), self.transfer(None, self.account(), self.account(), amount, pton=True),
+                             self.transfer(self.account(), self.account(), self.account(), amount))
+        if kind == "jetton_transfer":
+            # some of them are sender's own transfers of the input asset, the rest are between other accounts
+            if input_asset is not None and self.rng.random() < 0.25:
+                return self.jetton_transfer(input_asset, sender, self.account(), amount)
+            return self.jetton_transfer(self.account(), self.account(), self.account(), amount)
+        return {"success": True, "type": kind, "details": {"source": self.account(), "destination": self.account(), "value": str(amount)}}
+
+    def trace(self, hashes, depth):
+        # first depth+1 transactions make the deepest chain, the rest hang off random nodes above the bottom
+        nodes = [{"tx_hash": hashes[0], "children": []}]
+        levels = [0]
+        # nodes that may still get children
+        above_bottom = [0] if depth > 0 else []
+        for i, tx_hash in enumerate(hashes[1:], 1):
+            parent = i - 1 if i <= depth else self.rng.choice(above_bottom)
+            node = {"tx_hash": tx_hash, "children": []}
+            nodes[parent]["children"].append(node)
+            nodes.append(node)
+            levels.append(levels[parent] + 1)
+            if levels[i] < depth:
+                above_bottom.append(i)
+        return nodes[0]
+
+    def emulation(self, sender=SENDER_ADDRESS, input_token="ton", output_token=USDT, input_units=10**9,
+                  transactions=300, depth=6, splits=2, hops=2, actions=50, mix=DEFAULT_MIX):
+        sender = canonical_address(sender)
+        # None is TON, it goes through pTON legs
+        input_asset = None if input_token == "ton" else canonical_address(input_token)
+        output_asset = None if output_token == "ton" else canonical_address(output_token)
+        transactions = max(transactions, depth + 2)
+        hashes = [self.tx_hash() for _ in range(transactions)]
+        balance = self.rng.randint(10**12, 10**15)
+        lt = self.rng.randint(10**13, 10**14)
+        result = {"transactions": {}, "actions": [], "trace": self.trace(hashes, depth)}
+        for i, tx_hash in enumerate(hashes):
+            # sender has the first and the last transaction: the external and the incoming excess/jettons
+            account = sender if i in (0, transactions - 1) else self.account()
+            before = balance if account == sender else self.rng.randint(10**8, 10**12)
+            after = before - self.rng.randint(10**6, 10**8)
+            if account == sender:
+                # what sender pays: swapped TON (if any) plus gas
+                balance = before - (input_units if input_asset is None else 0) - self.rng.randint(10**8, 3 * 10**8)
+                after = balance
+            result["transactions"][tx_hash] = {
+                "account": account,
+                "hash": tx_hash,
+                "lt": str(lt + i),
+                "now": 1700000000,
+                "orig_status": "active",
+                "end_status": "active",
+                "total_fees": str(self.rng.randint(10**6, 10**7)),
+                "account_state_before": {"balance": str(before), "hash": self.tx_hash()},
+                "account_state_after": {"balance": str(after), "hash": self.tx_hash()},
+                "in_msg": {"hash": self.tx_hash(), "source": self.account(), "destination": account, "value": str(self.rng.randint(10**6, 10**9))},
+                "out_msgs": [{"hash": self.tx_hash(), "source": account, "destination": self.account()} for _ in range(self.rng.randint(0, 2))],
+            }
+        result["actions"] = self.route_actions(sender, input_asset, output_asset, input_units, splits, hops)
+        mix = parse_mix(mix) if isinstance(mix, str) else mix
+        kinds, weights = list(mix), list(mix.values())
+        for kind in self.rng.choices(kinds, weights, k=actions) if kinds else ():
+            result["actions"].append(self.extra_action(kind, sender, input_asset))
+        self.rng.shuffle(result["actions"])
+        return result
+
+
+def synthetic_emulation(seed=0, **kwargs):
+    return EmulationGenerator(seed).emulation(**kwargs)
+
+
+def emulation_assets(emulation):
+    # every asset of the actions, for prices and token metadata of benchmarks
+    assets = set()
+    for action in emulation["actions"]:
+        details = action["details"]
+        for transfer in (details.get("dex_incoming_transfer"), details.get("dex_outgoing_transfer"), details):
+            if transfer and transfer.get("asset"):
+                assets.add(transfer["asset"])
+    return assets
+
+
+def seed_database(path, days, interval=10, seed=0):
+    """
+    Writes synthetic sweeps every `interval` seconds for the last `days` days
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    create_database_if_not_exists(conn)
+    ids = SchemaIds(conn)
+    routes = [ids.route('[{"DEX": "stonfi_v2", "IN": "%d", "IN_ASSET": null, "IN_ASSET_SHORT": "TON", "OUT": "1", "OUT_ASSET_SHORT": "USD\\u20ae"}]' % rng.randint(1, 10**12), "[]")
+              for _ in range(50)]
+    swap_type_ids = [ids.swap_type(*swap_type) for swap_type in SWAP_TYPES]
+    aggregator_ids = [ids.aggregator(name) for name in AGGREGATORS]
+    now = int(time.time())
+    rows = []
+    for utime in range(now - int(days * 24 * 3600), now, interval):
+        for swap_type_id in swap_type_ids:
+            for aggregator_id in aggregator_ids:
+                rows.append((utime, swap_type_id, aggregator_id, rng.uniform(0, 10**6), rng.uniform(0.9, 1.0), rng.uniform(0.05, 0.3), rng.choice(routes)))
+    conn.executemany("""INSERT OR REPLACE INTO swap_results (utime, swap_type_id, aggregator_id, real_output, loss_ratio, gas_fees, route_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+
+def seeded_database(directory, days, interval=10):
+    """
+    Path of `days`-day database in directory, seeded on first use. Rows end at seeding time,
+    so databases older than SEED_MAX_AGE are seeded again to keep the dashboard window full.
+    """
+    path = os.path.join(directory, f"aggregator_{days}d.db")
+    if not os.path.exists(path) or os.path.getmtime(path) < time.time() - SEED_MAX_AGE:
+        seed_database(path + ".tmp", days, interval)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    emulation = commands.add_parser("emulation", help="write synthetic emulateTrace response")
+    emulation.add_argument("path")
+    emulation.add_argument("--transactions", type=int, default=300)
+    emulation.add_argument("--depth", type=int, default=6, help="depth of the trace tree")
+    emulation.add_argument("--splits", type=int, default=2, help="parallel routes of the swap")
+    emulation.add_argument("--hops", type=int, default=2, help="pools in every route")
+    emulation.add_argument("--actions", type=int, default=50, help="extra actions drawn from the mix")
+    emulation.add_argument("--mix", default=DEFAULT_MIX, help="weights of extra action types")
+    emulation.add_argument("--input-token", default="ton")
+    emulation.add_argument("--output-token", default=USDT)
+    emulation.add_argument("--seed", type=int, default=0)
+    database = commands.add_parser("database", help="write database with synthetic sweeps")
+    database.add_argument("path")
+    database.add_argument("--days", type=float, default=1)
+    database.add_argument("--interval", type=int, default=10, help="seconds between sweeps")
+    database.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.command == "emulation":
+        result = synthetic_emulation(args.seed, input_token=args.input_token, output_token=args.output_token,
+                                     transactions=args.transactions, depth=args.depth, splits=args.splits,
+                                     hops=args.hops, actions=args.actions, mix=args.mix)
+        with open(args.path, "w") as f:
+            json.dump(result, f)
+        print(f"{args.path}: {len(result['transactions'])} transactions, {len(result['actions'])} actions, {os.path.getsize(args.path)} bytes")
+    else:
+        started = time.perf_counter()
+        rows = seed_database(args.path, args.days, args.interval, args.seed)
+        print(f"{args.path}: {rows} rows in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Deadlines and hedged calls.
+
+Every upstream call of a swap (aggregator route, emulation) gets its own budget in seconds, so one hanging
+upstream costs at most its budget instead of the whole sweep. When the call hasn't answered after the
+`hedge_percentile` of its recent latencies, we start the same call once more and take whichever answers first
+(the other one is cancelled). Most of the tail latency of HTTP APIs comes from single slow requests,
+so a hedge after p95 cuts the tail for about 5% of extra requests.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+
+# percentile of recent latencies after which the hedged call is started, 0 disables hedging
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# we don't hedge until we have seen this many successful calls
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+
+class LatencyTracker:
+    """
+    Latencies of last `size` successful calls of one upstream
+    """
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+async def _hedged(call, tracker, hedge_percentile):
+    async def attempt():
+        started = time.monotonic()
+        result = await call()
+        if tracker is not None:
+            tracker.observe(time.monotonic() - started)
+        return result
+
+    tasks = [asyncio.ensure_future(attempt())]
+    try:
+        delay = tracker.percentile(hedge_percentile) if tracker is not None and hedge_percentile else None
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                tasks.append(asyncio.ensure_future(attempt()))
+        while True:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            pending = [task for task in tasks if not task.done()]
+            if not pending:
+                # all attempts failed, report the first failure
+                return tasks[0].result()
+            tasks = pending
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call_with_deadline(call, budget, tracker=None, hedge_percentile=HEDGE_PERCENTILE):
+    """
+    Awaits call() (coroutine function without arguments) for at most `budget` seconds, raises asyncio.TimeoutError after that.
+    With tracker the call is hedged after `hedge_percentile` of its latencies, hedged attempts share the budget.
+    """
+    return await asyncio.wait_for(_hedged(call, tracker, hedge_percentile), budget)
@@ -1,10 +1,17 @@
 import pytoniq_core
 from pytoniq_core.tlb.transaction import ExternalMsgInfo, MessageAny, InternalMsgInfo, CurrencyCollection
-from pytoniq_core.boc.address import Address
+# sender and aggregator contract addresses repeat in every message, so they are parsed once
+from addresses import parse_address
 from pytoniq_core.tlb.custom.wallet import WalletMessage
+import asyncio
 import base64
+import multiprocessing
+import os
+import time
 import pytoniq
-from pytoniq_core.boc import Cell
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pytoniq_core.boc import Builder, Cell
 from pytoniq.contract.wallets import WalletV3, WalletV4
 
 def build_payload(payload):
@@ -20,8 +27,8 @@ def build_wallet_message(SENDER_ADDRESS, address, amount, payload, mode = 3):
         ihr_disabled=True,
         bounce=True,
         bounced=False,
-        src = Address(SENDER_ADDRESS),
-        dest = Address(address),
+        src = parse_address(SENDER_ADDRESS),
+        dest = parse_address(address),
         value = CurrencyCollection(amount),
         ihr_fee = 0,
         fwd_fee = 0,
@@ -31,20 +38,62 @@ def build_wallet_message(SENDER_ADDRESS, address, amount, payload, mode = 3):
     message =  MessageAny(info=info, init=None, body=payload)
     return WalletMessage(send_mode = mode, message = message)
 
+WALLET_ID = 698983191 # default wallet id
+# toncenter emulates with ignore_chksig, so signature may be anything, and we don't spend ed25519 on it
+ZERO_SIGNATURE = bytes(64)
+
+
 # we want to build external message that sends a list of internal messages
-def raw_build_external_message(SENDER_ADDRESS, seqno, messages):
+def raw_build_external_message(SENDER_ADDRESS, seqno, messages, valid_until=None):
     external_message_body = WalletV4.raw_create_transfer_msg(
         private_key = b"\x07"*32, # we don't need private key, so we can put any
         seqno = seqno,
-        wallet_id = 698983191, #default wallet id
-        messages = messages
+        wallet_id = WALLET_ID,
+        messages = messages,
+        valid_until = valid_until
     )
-    external = WalletV4.create_external_msg(dest = Address(SENDER_ADDRESS),
+    external = WalletV4.create_external_msg(dest = parse_address(SENDER_ADDRESS),
                                           body = external_message_body)
     return external
 
 
-def build_external_message(SENDER_ADDRESS, seqno, messages):
+@lru_cache(maxsize=64)
+def transfer_header(wallet_id, seqno, valid_until):
+    # the part of wallet v4 transfer body before the messages, as WalletV4.raw_create_transfer_msg writes it
+    header = Builder().store_uint(wallet_id, 32)
+    if seqno == 0:
+        header.store_bits('1' * 32)
+    else:
+        header.store_uint(valid_until, 32)
+    header.store_uint(seqno, 32)
+    header.store_uint(0, 8) # op code
+    return header.end_cell()
+
+
+# valid_until of emulation messages is rounded up to this many seconds, so the same transfers built
+# within one step give byte-identical BOC and can share one emulation (see EmulationCache in toncenter.py)
+VALID_UNTIL_STEP = 60
+
+
+def emulation_valid_until():
+    # at least 60 seconds ahead, like before rounding
+    return (int(time.time()) + 60 + VALID_UNTIL_STEP - 1) // VALID_UNTIL_STEP * VALID_UNTIL_STEP
+
+
+def raw_build_emulation_message(SENDER_ADDRESS, seqno, messages, valid_until=None):
+    """
+    Same external message as raw_build_external_message, but with zero signature instead of real one,
+    so it is only good for emulation. Apart from the signature the body is bit for bit the same.
+    """
+    if valid_until is None:
+        valid_until = emulation_valid_until()
+    body = Builder().store_bytes(ZERO_SIGNATURE).store_cell(transfer_header(WALLET_ID, seqno, valid_until))
+    for message in messages:
+        body.store_cell(message.serialize())
+    return MessageAny(info=ExternalMsgInfo(None, parse_address(SENDER_ADDRESS), 0), init=None, body=body.end_cell())
+
+
+def build_wallet_messages(SENDER_ADDRESS, messages):
     msgs = []
     for msg in messages:
         amount = msg.get("value")
@@ -56,4 +105,76 @@ def build_external_message(SENDER_ADDRESS, seqno, messages):
             payload = msg.get("cell")
         # payload can be empty
         msgs.append(build_wallet_message(SENDER_ADDRESS, msg["address"], amount, payload, msg.get("send_mode", 3)))
-    return base64.b64encode(raw_build_external_message(SENDER_ADDRESS, seqno, msgs).serialize().to_boc())
\ No newline at end of file
+    return msgs
+
+
+def build_external_message(SENDER_ADDRESS, seqno, messages, valid_until=None):
+    msgs = build_wallet_messages(SENDER_ADDRESS, messages)
+    return base64.b64encode(raw_build_external_message(SENDER_ADDRESS, seqno, msgs, valid_until).serialize().to_boc())
+
+
+def build_emulation_message(SENDER_ADDRESS, seqno, messages, valid_until=None):
+    # what we send to emulation, see raw_build_emulation_message
+    msgs = build_wallet_messages(SENDER_ADDRESS, messages)
+    return base64.b64encode(raw_build_emulation_message(SENDER_ADDRESS, seqno, msgs, valid_until).serialize().to_boc())
+
+
+"""
+Building BOC is CPU-bound (parsing payload cells, building and serializing the wallet body), and on the event loop
+thread it delays network I/O of every other swap. So the pipeline builds messages in a process pool:
+workers are started once with pytoniq already imported and warmed up by building one message,
+they take transaction dicts and return base64 BOC of build_emulation_message.
+MESSAGE_WORKERS=0 builds messages inline.
+"""
+
+# default is one worker per core, but at least one
+MESSAGE_WORKERS = int(os.getenv("MESSAGE_WORKERS", str(max(1, (os.cpu_count() or 1)))))
+# any valid address works for warm-up
+WARM_UP_ADDRESS = "UQAPPgN25OQh3EOqqt0v_CRmScxa-_ulVwm5NESN1DO4gZzD"
+
+_message_pool = None
+
+
+def _warm_up():
+    # first build fills pytoniq caches (TL-B schemes, crypto backend), we don't want the first swap to pay for it
+    build_emulation_message(WARM_UP_ADDRESS, 1, [{"address": WARM_UP_ADDRESS, "value": "1"}])
+
+
+def _ping():
+    return os.getpid()
+
+
+def get_message_pool():
+    global _message_pool
+    if _message_pool is None and MESSAGE_WORKERS > 0:
+        # spawn, because forking a process with running event loop and SQLite writer thread is not safe
+        _message_pool = ProcessPoolExecutor(max_workers=MESSAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_warm_up)
+    return _message_pool
+
+
+async def start_message_pool():
+    """
+    Starts all workers now instead of on the first swaps, returns their number
+    """
+    pool = get_message_pool()
+    if pool is None:
+        return 0
+    loop = asyncio.get_running_loop()
+    # workers are spawned on demand, so we keep all of them busy at once
+    pids = await asyncio.gather(*[loop.run_in_executor(pool, _ping) for _ in range(MESSAGE_WORKERS)])
+    return len(set(pids))
+
+
+async def build_emulation_message_async(SENDER_ADDRESS, seqno, messages, valid_until=None):
+    pool = get_message_pool()
+    if pool is None:
+        return build_emulation_message(SENDER_ADDRESS, seqno, messages, valid_until)
+    return await asyncio.get_running_loop().run_in_executor(pool, build_emulation_message, SENDER_ADDRESS, seqno, messages, valid_until)
+
+
+def close_message_pool():
+    global _message_pool
+    if _message_pool is not None:
+        _message_pool.shutdown()
+        _message_pool = None
@@ -0,0 +1,166 @@
+"""
+Process metrics in Prometheus text format.
+
+Counters, gauges and histograms with labels, kept in memory of the process and rendered on request:
+the tester serves them on METRICS_PORT (see serve_metrics), server.py on its /metrics route.
+Metrics are updated from the event loop, the SQLite writer thread and HTTP worker threads, so every metric has a lock.
+
+    from metrics import histogram
+    upstream_seconds = histogram("upstream_request_seconds", "Latency of upstream HTTP requests")
+    upstream_seconds.observe(0.25, upstream="toncenter.com", endpoint="/api/v2/getMasterchainInfo", status="200")
+"""
+
+import http.server
+import os
+import threading
+from bisect import bisect_left
+
+# tester process serves /metrics on this port, 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+# seconds, from a fast cache lookup to an emulation that hit its budget
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        # sorted (label, value) tuple -> value
+        self.values = {}
+
+    def samples(self):
+        # [(name suffix, labels, value)]
+        with self.lock:
+            return [("", labels, value) for labels, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    samples.append(("_bucket", labels + (("le", _format_value(float(bound))),), cumulative))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, cumulative))
+        return samples
+
+
+# name -> metric of this process
+REGISTRY = {}
+
+
+def _register(cls, name, *args):
+    metric = REGISTRY.get(name)
+    if metric is None:
+        metric = REGISTRY[name] = cls(name, *args)
+    return metric
+
+
+def counter(name, documentation):
+    return _register(Counter, name, documentation)
+
+
+def gauge(name, documentation):
+    return _register(Gauge, name, documentation)
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, buckets)
+
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY.values()) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scraped every few seconds, not worth a line each time
+        pass
+
+
+def serve_metrics(port=METRICS_PORT, host="0.0.0.0"):
+    """
+    Serves /metrics of this process from a background thread, returns the server or None if port is 0
+    """
+    if not port:
+        return None
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,142 @@
+"""
+Staged pipeline over asyncio queues.
+
+A sweep is a list of jobs (one per swap and aggregator) that go through stages, e.g.
+route fetching -> message building -> emulation -> assessment -> persistence.
+Every stage has its own bounded input queue and its own number of workers, so while emulation
+(the slowest stage, paced by toncenter quota) is busy, routes of the next jobs are already fetched
+and finished emulations are assessed. Bounded queues give backpressure: a fast stage can run only
+`queue_size` jobs ahead of the next one, so routes don't get stale waiting for emulation.
+
+A job that fails in some stage gets `error` set and skips the remaining stages, except the ones created with
+always=True (persistence), so failed jobs are still recorded.
+
+A stage created with `key` (e.g. aggregator of the job) is partitioned: every key gets its own queue and
+`concurrency` workers, so jobs of one key that hang until their timeout don't hold up jobs of the others.
+When the first stage is partitioned, every partition is fed separately for the same reason.
+"""
+
+import asyncio
+import time
+
+from metrics import gauge, histogram
+
+stage_seconds = histogram("pipeline_stage_seconds", "Time jobs spent in the handler of a pipeline stage by outcome")
+queue_depth = gauge("pipeline_queue_depth", "Jobs waiting in front of a pipeline stage")
+
+
+class Job:
+    """
+    Base of pipeline items, stages set attributes on it
+    """
+    def __init__(self):
+        self.error = None
+        # stage where the job failed
+        self.failed_stage = None
+
+
+class Stage:
+    def __init__(self, name, handler, concurrency=1, queue_size=8, always=False, key=None):
+        self.name = name
+        # async function of a job
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.always = always
+        # function of a job, None for one partition
+        self.key = key
+        # partition -> queue
+        self.queues = {}
+        self.reset()
+
+    def partition(self, job):
+        return None if self.key is None else self.key(job)
+
+    def depth(self):
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    def reset(self, partitions=(None,)):
+        self.queues = {partition: asyncio.Queue(self.queue_size) for partition in partitions}
+        # queue-depth and throughput metrics, see stats()
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.depth_sum = 0
+        self.depth_samples = 0
+
+    async def put(self, job):
+        await self.queues[self.partition(job)].put(job)
+        depth = self.depth()
+        queue_depth.set(depth, stage=self.name)
+        self.max_depth = max(self.max_depth, depth)
+        self.depth_sum += depth
+        self.depth_samples += 1
+
+    async def _work(self, queue, put_next):
+        while True:
+            job = await queue.get()
+            queue_depth.set(self.depth(), stage=self.name)
+            if job.error is None or self.always:
+                started = time.monotonic()
+                outcome = "ok"
+                try:
+                    await self.handler(job)
+                except Exception as e:
+                    job.error = e
+                    job.failed_stage = self.name
+                    self.failed += 1
+                    outcome = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+                elapsed = time.monotonic() - started
+                stage_seconds.observe(elapsed, stage=self.name, outcome=outcome)
+                self.busy += elapsed
+                self.processed += 1
+            queue.task_done()
+            await put_next(job)
+
+    def stats(self, elapsed):
+        # utilization is the share of time workers of the stage were busy
+        workers = self.concurrency * len(self.queues)
+        utilization = self.busy / (elapsed * workers) if elapsed else 0
+        mean_depth = self.depth_sum / self.depth_samples if self.depth_samples else 0
+        return (f"{self.name:>8}: {self.processed} done, {self.failed} failed, workers {workers} {utilization:.0%} busy, "
+                f"queue mean {mean_depth:.1f} max {self.max_depth}/{self.queue_size * len(self.queues)}")
+
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = stages
+        self.elapsed = 0
+
+    async def run(self, jobs):
+        """
+        Pushes jobs through all stages, returns them in the order they finished
+        """
+        started = time.monotonic()
+        done = asyncio.Queue()
+        workers = []
+        for i, stage in enumerate(self.stages):
+            stage.reset({stage.partition(job) for job in jobs} or {None})
+            put_next = self.stages[i + 1].put if i + 1 < len(self.stages) else done.put
+            for queue in stage.queues.values():
+                workers += [asyncio.create_task(stage._work(queue, put_next)) for _ in range(stage.concurrency)]
+
+        async def feed(jobs):
+            for job in jobs:
+                await self.stages[0].put(job)
+
+        # a full queue of one partition must not stop feeding of the others
+        groups = {}
+        for job in jobs:
+            groups.setdefault(self.stages[0].partition(job), []).append(job)
+        workers += [asyncio.create_task(feed(group)) for group in groups.values()]
+        try:
+            return [await done.get() for _ in jobs]
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.elapsed = time.monotonic() - started
+
+    def stats(self):
+        return "\n".join(stage.stats(self.elapsed) for stage in self.stages)
@@ -0,0 +1,71 @@
+"""
+Background price service.
+
+Prices are downloaded every PRICE_REFRESH_INTERVAL seconds by a background task, and evaluations read
+the current snapshot without any I/O. A snapshot is never modified after it is built, the service just
+swaps the reference to the new one, so a sweep that took a snapshot values all its swaps with the same prices
+even if refresh happens in the middle of it. Snapshot utime is stored with every row (see storage.py).
+"""
+
+import asyncio
+import os
+import time
+
+from aggregators import get_prices
+
+PRICE_REFRESH_INTERVAL = float(os.getenv("PRICE_REFRESH_INTERVAL", "30"))
+
+
+class PriceSnapshot:
+    def __init__(self, prices, utime):
+        # raw uppercase address (or "ton") -> USD price of the smallest unit
+        self.prices = prices
+        # when prices were fetched
+        self.utime = utime
+
+    def age(self):
+        return time.time() - self.utime
+
+
+class PriceService:
+    def __init__(self, interval=PRICE_REFRESH_INTERVAL, fetch=get_prices):
+        self.interval = interval
+        self.fetch = fetch
+        self.snapshot = None
+        self.task = None
+
+    async def refresh(self):
+        prices = await self.fetch()
+        self.snapshot = PriceSnapshot(prices, int(time.time()))
+        return self.snapshot
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # old snapshot stays in use, its age tells how stale it is
+                print("Error: failed to refresh prices:", repr(e))
+
+    async def start(self):
+        # the first snapshot is fetched before the first sweep
+        await self.refresh()
+        self.task = asyncio.create_task(self._refresh_loop())
+
+    async def get(self):
+        """
+        Current snapshot, fetched right away if the service wasn't started
+        """
+        if self.snapshot is None:
+            return await self.refresh()
+        return self.snapshot
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+price_service = PriceService()
@@ -0,0 +1,84 @@
+"""
+Token-bucket rate limiter with priorities.
+
+Toncenter API key has a fixed requests-per-second quota shared by all endpoints (v2, v3, emulate).
+Instead of sleeping pessimistically between swaps we route every toncenter call through one limiter:
+bucket is refilled with `rate` tokens per second up to `burst`, each request takes one token,
+and waiting requests are released in priority order (lower value goes first, FIFO inside one priority).
+
+When the API answers 429 we call backoff(): requests are paused for a while and the rate is
+halved, then it slowly recovers back to the configured rate on successful responses.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+
+# request priorities, lower goes first
+PRIORITY_EMULATE = 0
+PRIORITY_CHAIN_STATE = 1
+PRIORITY_METADATA = 2
+PRIORITY_NAMES = {PRIORITY_EMULATE: "emulate", PRIORITY_CHAIN_STATE: "chain_state", PRIORITY_METADATA: "metadata"}
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=1, min_rate=0.2, recovery=0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        # how much of max_rate we win back after each successful request
+        self.recovery = recovery
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.waiters = []
+        self.counter = itertools.count()
+        self.timer = None
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority=PRIORITY_METADATA):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        self._dispatch()
+        await future
+
+    def _dispatch(self):
+        now = time.monotonic()
+        self._refill(now)
+        while self.waiters and now >= self.paused_until:
+            # cancelled waiters are dropped without spending a token
+            if self.waiters[0][2].done():
+                heapq.heappop(self.waiters)
+                continue
+            if self.tokens < 1:
+                break
+            _, _, future = heapq.heappop(self.waiters)
+            self.tokens -= 1
+            future.set_result(None)
+        if self.waiters and self.timer is None:
+            delay = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+            self.timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self._dispatch()
+
+    def backoff(self, retry_after=None):
+        """
+        Called on HTTP 429: pause all requests and halve the rate
+        """
+        self.rate = max(self.min_rate, self.rate / 2)
+        pause = retry_after if retry_after is not None else 1 / self.rate
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + pause)
+        self.tokens = 0
+        self.updated = now
+
+    def success(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery)
@@ -0,0 +1,193 @@
+"""
+Local stand-in for toncenter, swap.coffee, DeDust and xdelta.
+
+Record real responses once (see HTTP_RECORD_PATH in sessions.py):
+
+    HTTP_RECORD_PATH=recordings.jsonl TONCENTER_API_KEY=YOUR_KEY python3 aggregator_tester.py
+
+and serve them back without network or api keys:
+
+    python3 replay.py recordings.jsonl --port 8100 --latency 0.2 --jitter 0.1 --error-rate 0.01 --rate-limit-rate 0.05
+    REPLAY_URL=http://127.0.0.1:8100 TONCENTER_RPS=1000 python3 aggregator_tester.py
+
+Every upstream lives under its host, e.g. http://127.0.0.1:8100/toncenter.com/api/v2/getMasterchainInfo.
+Requests are matched to recordings by method, host, path, query and json body. Emulation requests carry wallet seqno,
+valid_until and mc block that differ from run to run, so they are matched by the internal messages of the BOC only.
+When nothing matches exactly, any recording of the same endpoint is served (unless --strict), round-robin.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+from collections import Counter, defaultdict
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+from pytoniq_core.boc import Cell
+from pytoniq_core.tlb.transaction import MessageAny
+
+REPLAY_HOST = os.getenv("REPLAY_HOST", "127.0.0.1")
+REPLAY_PORT = int(os.getenv("REPLAY_PORT", "8100"))
+
+
+def emulation_key(boc):
+    # wallet body refs are the internal messages, they only depend on the routes aggregators returned
+    message = MessageAny.deserialize(Cell.one_from_boc(base64.b64decode(boc)).begin_parse())
+    return [ref.hash.hex() for ref in message.body.refs]
+
+
+def request_key(method, host, path, query, body):
+    if body:
+        try:
+            body = json.loads(body)
+        except ValueError:
+            pass
+        if path.endswith("/emulateTrace") and isinstance(body, dict) and "boc" in body:
+            body = emulation_key(body["boc"])
+    # metadata batches may list the same addresses in another order
+    query = sorted(parse_qsl(query, keep_blank_values=True))
+    key = json.dumps([method, host, path, query, body], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class Recordings:
+    def __init__(self, records):
+        # request key -> records, endpoint -> records
+        self.exact = defaultdict(list)
+        self.endpoints = defaultdict(list)
+        # how many times every list was served, for round-robin
+        self.served = Counter()
+        for record in records:
+            key = request_key(record["method"], record["host"], record["path"], record["query"], record["request"])
+            self.exact[key].append(record)
+            self.endpoints[(record["method"], record["host"], record["path"])].append(record)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    def _next(self, key, records):
+        record = records[self.served[key] % len(records)]
+        self.served[key] += 1
+        return record
+
+    def find(self, method, host, path, query, body, strict=False):
+        """
+        Returns (record, "exact" or "endpoint"), or (None, "miss")
+        """
+        key = request_key(method, host, path, query, body)
+        if key in self.exact:
+            return self._next(key, self.exact[key]), "exact"
+        endpoint = (method, host, path)
+        if not strict and endpoint in self.endpoints:
+            return self._next(endpoint, self.endpoints[endpoint]), "endpoint"
+        return None, "miss"
+
+
+class ReplayServer:
+    def __init__(self, recordings, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0,
+                 recorded_latency=False, strict=False, seed=None):
+        self.recordings = recordings
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        # sleep as long as the real upstream took when recording, instead of fixed latency
+        self.recorded_latency = recorded_latency
+        self.strict = strict
+        # fixed seed gives the same sequence of delays, errors and 429s on every run
+        self.random = random.Random(seed)
+        self.stats = Counter()
+        self.runner = None
+
+    def delay(self, record):
+        latency = record["elapsed"] if self.recorded_latency and record is not None else self.latency
+        return max(0.0, latency + self.random.uniform(-self.jitter, self.jitter))
+
+    async def handle(self, request):
+        host, _, path = request.path.lstrip("/").partition("/")
+        body = (await request.read()).decode("utf-8")
+        record, match = self.recordings.find(request.method, host, "/" + path, request.query_string, body, self.strict)
+        # all random draws happen in the same order for every request, so the seed defines the run
+        delay = self.delay(record)
+        limited = self.random.random() < self.rate_limit_rate
+        failed = self.random.random() < self.error_rate
+        await asyncio.sleep(delay)
+        if limited:
+            self.stats["429"] += 1
+            return web.json_response({"ok": False, "error": "Ratelimit exceed"}, status=429,
+                                     headers={"Retry-After": str(self.retry_after)})
+        if failed:
+            self.stats["error"] += 1
+            return web.json_response({"ok": False, "error": "injected error"}, status=502)
+        self.stats[match] += 1
+        if record is None:
+            return web.json_response({"ok": False, "error": f"no recording for {request.method} {request.path}"}, status=404)
+        return web.Response(status=record["status"], text=record["body"], content_type=record["content_type"])
+
+    async def start(self, host=REPLAY_HOST, port=REPLAY_PORT):
+        """
+        Starts serving in the running event loop, returns base url for REPLAY_URL
+        """
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+def add_fault_arguments(parser):
+    # shared with benchmarks/sweep_bench.py
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every response is delayed")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform +- seconds added to latency")
+    parser.add_argument("--recorded-latency", action="store_true", help="delay as long as the recorded response took")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 502")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of 429 responses, seconds")
+    parser.add_argument("--strict", action="store_true", help="404 instead of another recording of the same endpoint")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def server_from_arguments(args):
+    return ReplayServer(Recordings.load(args.recordings), args.latency, args.jitter, args.error_rate, args.rate_limit_rate,
+                        args.retry_after, args.recorded_latency, args.strict, args.seed)
+
+
+async def serve(server, host, port):
+    url = await server.start(host, port)
+    print(f"Replaying {sum(map(len, server.recordings.exact.values()))} recordings at {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", help="jsonl file written with HTTP_RECORD_PATH")
+    parser.add_argument("--host", default=REPLAY_HOST)
+    parser.add_argument("--port", type=int, default=REPLAY_PORT)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_arguments(args)
+    try:
+        asyncio.run(serve(server, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    print("Served:", dict(server.stats))
+
+
+if __name__ == "__main__":
+    main()
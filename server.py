@@ -1,9 +1,6 @@
 """
-We have the following database schema:
-    conn = sqlite3.connect('aggregator.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS swaps
-                 (utime INTEGER, aggregator TEXT, swap_type TEXT, real_output REAL, loss_ratio REAL, short_descriptions_out TEXT, short_descriptions_in TEXT, gas_fees REAL)''')
+We read data through `swaps` view (see storage.py for the normalized schema behind it):
+    swaps (utime INTEGER, aggregator TEXT, swap_type TEXT, real_output REAL, loss_ratio REAL, short_descriptions_out TEXT, short_descriptions_in TEXT, gas_fees REAL, status TEXT, price_utime INTEGER)
 """
 
 """
@@ -28,14 +25,39 @@ When we place cursor upon graph point, we should see the following information:
 
 """
 We want to use simples webserver possible: SimpleHTTPServer.
+Requests are handled by a fixed pool of worker threads (SERVER_WORKERS), every worker has its own
+read-only SQLite connection, and at most MAX_RENDERS heavy renders (dashboard, /api/swaps) run at the same time.
 """
 
 import sqlite3
 import json
+import os
+import queue
+import threading
+import time
+import email.utils
+import gzip
+import hashlib
+import urllib.parse
+from collections import OrderedDict, deque
+from storage import DB_PATH
+from api import rank_rows, get_swap_types, resolve_swap_type, get_swaps_version, get_swaps
+import metrics
 import http.server
 from datetime import datetime
 from datetime import timedelta
 
+# we show data for prev 24 hours
+WINDOW = timedelta(days=1)
+# points that fell out of the window are dropped once the oldest of them is this much seconds out of it
+EVICT_SLACK = int(os.getenv("EVICT_SLACK", "60"))
+
+# short names of tokens for graph titles, other tokens are shown as is
+TOKEN_NAMES = {
+    "EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs": "USDT",
+    "EQCJbp0kBpPwPoBG-U5C-cWfP_jnksvotGfArPF50Q9Qiv9h": "RAFF",
+}
+
 template = """
 <!DOCTYPE html>
 
@@ -45,130 +67,18 @@ template = """
     <script src="https://cdn.plot.ly/plotly-latest.min.js"></script>
 </head>
 <body>
-    <div id="graph_1ton_usdt"></div>
-    <script>
-        var data = %(1ton_usdt)s;
-        var layout = {
-            title: 'Swap 1 ton->USDT',
-            yaxis: {
-                autorange: 'reversed'
-            },
-            "xaxis": {
-                "type": 'date'
-            }
-        };
-        Plotly.newPlot('graph_1ton_usdt', data, layout);
-    </script>
-    <div id="graph_100ton_usdt"></div>
-    <script>
-        var data = %(100ton_usdt)s;
-        var layout = {
-            title: 'Swap 100 ton->USDT',
-            yaxis: {
-                autorange: 'reversed'
-            },
-            "xaxis": {
-                "type": 'date'
-            }
-        };
-        Plotly.newPlot('graph_100ton_usdt', data, layout);
-    </script>
-
-        <div id="graph_10000ton_usdt"></div>
-    <script>
-        var data = %(10000ton_usdt)s;
-        var layout = {
-            title: 'Swap 10000 ton->USDT',
-            yaxis: {
-                autorange: 'reversed'
-            },
-            "xaxis": {
-                "type": 'date'
-            }
-        };
-        Plotly.newPlot('graph_10000ton_usdt', data, layout);
-    </script>
-
-    <div id="graph_1ton_raff"></div>
-    <script>
-        var data = %(1ton_raff)s;
-        var layout = {
-            title: 'Swap 1 ton->RAFF',
-            yaxis: {
-                autorange: 'reversed'
-            },
-            "xaxis": {
-                "type": 'date'
-            }
-        };
-        Plotly.newPlot('graph_1ton_raff', data, layout);
-    </script>
-    <div id="graph_100ton_raff"></div>
-    <script>
-        var data = %(100ton_raff)s;
-        var layout = {
-            title: 'Swap 100 ton->RAFF',
-            yaxis: {
-                autorange: 'reversed'
-            },
-            "xaxis": {
-                "type": 'date'
-            }
-        };
-        Plotly.newPlot('graph_100ton_raff', data, layout);
-    </script>
-
-        <div id="graph_10000ton_raff"></div>
-    <script>
-        var data = %(10000ton_raff)s;
-        var layout = {
-            title: 'Swap 10000 ton->RAFF',
-            yaxis: {
-                autorange: 'reversed'
-            },
-            "xaxis": {
-                "type": 'date'
-            }
-        };
-        Plotly.newPlot('graph_10000ton_raff', data, layout);
-    </script>
-
-    
-
-    <div id="graph_1usdt_raff"></div>
-    <script>
-        var data = %(1usdt_raff)s;
-        var layout = {
-            title: 'Swap 1 usdt->RAFF',
-            yaxis: {
-                autorange: 'reversed'
-            },
-            "xaxis": {
-                "type": 'date'
-            }
-        };
-        Plotly.newPlot('graph_1usdt_raff', data, layout);
-    </script>
-    <div id="graph_100usdt_raff"></div>
-    <script>
-        var data = %(100usdt_raff)s;
-        var layout = {
-            title: 'Swap 100 usdt->RAFF',
-            yaxis: {
-                autorange: 'reversed'
-            },
-            "xaxis": {
-                "type": 'date'
-            }
-        };
-        Plotly.newPlot('graph_100usdt_raff', data, layout);
-    </script>
+%(panels)s
+</body>
+</html>
+"""
 
-        <div id="graph_10000usdt_raff"></div>
+# one panel per swap type that has data
+panel_template = """
+    <div id="graph_%(id)s"></div>
     <script>
-        var data = %(10000usdt_raff)s;
+        var data = %(data)s;
         var layout = {
-            title: 'Swap 10000 usdt->RAFF',
+            title: '%(title)s',
             yaxis: {
                 autorange: 'reversed'
             },
@@ -176,19 +86,31 @@ template = """
                 "type": 'date'
             }
         };
-        Plotly.newPlot('graph_10000usdt_raff', data, layout);
+        Plotly.newPlot('graph_%(id)s', data, layout);
     </script>
-</body>
-</html>
 """
 
-def get_data(swap_type):
-    conn = sqlite3.connect('aggregator.db')
+default_colors = {"Coffee.swap": "#37262c", "DeDust": "#ffb304"}
+
+def get_data(conn, since, high_waters=None):
+    """
+    All rows of all swap types newer than since, or than high_waters[swap_type_id] if it is later, in one query,
+    ordered by swap type and time:
+    (swap_type_id, swap_type, utime, aggregator, real_output, loss_ratio, route_id, short_descriptions_out, gas_fees)
+    """
     c = conn.cursor()
-    c.execute("SELECT * FROM swaps WHERE swap_type = ? AND utime > ?", (swap_type, int((datetime.now() - timedelta(days=1)).timestamp())))
-    data = c.fetchall()
-    conn.close()
-    return data
+    # outer loop goes over few swap types, for every one of them rows are a range scan of swap_results primary key
+    # starting from its own high-water, so one type that is behind doesn't make the others rescan
+    c.execute("""SELECT t.id, t.name, r.utime, a.name, r.real_output, r.loss_ratio, r.route_id, ro.short_descriptions_out, r.gas_fees
+                 FROM swap_types t
+                 JOIN swap_results r ON r.swap_type_id = t.id
+                                     AND r.utime > max(?, coalesce(json_extract(?, '$."' || t.id || '"'), 0))
+                 -- timed out and failed measurements have nothing to rank
+                                     AND r.loss_ratio IS NOT NULL
+                 JOIN aggregators a ON a.id = r.aggregator_id
+                 LEFT JOIN routes ro ON ro.id = r.route_id
+                 ORDER BY t.id, r.utime""", (since, json.dumps(high_waters or {})))
+    return c.fetchall()
 
 def convert_route(routes):
     """
@@ -213,79 +135,392 @@ def convert_route(routes):
     
 
 
-def get_graph(swap_type):
-    data = get_data(swap_type)
-    # we want to group data points by time
-    # the inside group find placement for each aggregator
-    # then plot line for each aggregator
+def swap_title(swap_type):
+    # "100 ton->EQCx..." -> "Swap 100 ton->USDT"
+    amount, pair = swap_type.split(" ", 1)
+    input_token, output_token = pair.split("->", 1)
+    return f"Swap {amount} {TOKEN_NAMES.get(input_token, input_token)}->{TOKEN_NAMES.get(output_token, output_token)}"
 
-    timepoints = {}
-    for x in data:
-        timepoints[x[0]] = timepoints.get(x[0], [])
-        timepoints[x[0]].append(list(x))
-    
-    # augment data with placement
-    for timepoint in timepoints:
-        timepoints[timepoint] = sorted(timepoints[timepoint], key=lambda x: -x[4])
-        for i, x in enumerate(timepoints[timepoint]):
-            if i != 0 and x[4] == timepoints[timepoint][i-1][4]:
-                x.append(i)
-            else:
-                x.append(i+1)
-    
-    data = []
-
-    aggreagators = {}
-    # now we want separate lines for each aggregator, with y equal to placement
-    default_colors = {"Coffee.swap": "#37262c", "DeDust": "#ffb304"}
-    for timepoint in timepoints:        
-        for x in timepoints[timepoint]:
-            name = x[1]
-            if not name in aggreagators:
-                aggreagators[name] = {
-                    "x": [],
-                    "y": [],
-                    "mode": "lines+markers",
-                    "name": name,
-                    "text": []
-                }
+
+def rank_timepoint(group):
+    """
+    group is rows of one swap type at one utime, returns [(aggregator, place, hover text)]
+    """
+    return [(x[3], place, f"real_output: {x[4]}</br>loss_ratio: {x[5]}</br>gas_fees: {x[8]}</br>{x[7]}")
+            for x, place in rank_rows(group, lambda x: x[5])]
+
+
+class PlacementCache:
+    """
+    Ranked timepoints of every swap type for the last WINDOW, kept between requests.
+
+    On every request we only pull rows newer than the high-water utime of each swap type,
+    rank them and append to the cached series, and drop points that fell out of the window.
+    Every point is serialized to json once, when it arrives, so plotly traces of a swap type are just joined
+    from ready fragments, and the page is rebuilt only when some points changed.
+    Repeated dashboard loads cost one empty range query regardless of how much history is kept.
+    """
+    def __init__(self, window=WINDOW, evict_slack=EVICT_SLACK):
+        self.window = window
+        # old points are dropped in batches once the oldest of them is evict_slack seconds out of the window,
+        # otherwise the page would be rebuilt every second just because the window moved
+        self.evict_slack = evict_slack
+        self.lock = threading.Lock()
+        # swap_type_id -> {
+        #   "name": swap_type, "high_water": utime,
+        #   "points": deque of (utime, [aggregator names]),
+        #   "lines": {aggregator: {"x": deque, "y": deque, "text": deque}} with json fragments,
+        #   "traces": json or None
+        # }
+        self.series = {}
+        self.page = None
+        # last complete page, unlike self.page it is never reset
+        self.served = None
+
+    def _since(self):
+        return int((datetime.now() - self.window).timestamp())
+
+    def _append(self, rows, since):
+        changed = set()
+        # routes repeat a lot, so every distinct route is parsed and formatted once
+        route_texts = {}
+        group = []
+
+        def flush(group):
+            series = self.series.setdefault(group[0][0], {"name": group[0][1], "high_water": since, "points": deque(), "lines": {}, "traces": None})
+            utime = group[0][2]
+            if utime <= series["high_water"]:
+                # already have this timepoint, e.g. from the rows of the other swap type with older high-water
+                return
+            for x in group:
+                route_text = route_texts.get(x[6])
+                if route_text is None:
+                    route_text = route_texts[x[6]] = convert_route(json.loads(x[7]))
+                x[7] = route_text
+            names = []
+            for name, place, text in rank_timepoint(group):
+                line = series["lines"].get(name)
+                if line is None:
+                    line = series["lines"][name] = {"x": deque(), "y": deque(), "text": deque()}
+                line["x"].append(str(utime*1000))
+                line["y"].append(str(place))
+                line["text"].append(json.dumps(text))
+                names.append(name)
+            series["points"].append((utime, names))
+            series["high_water"] = utime
+            changed.add(group[0][0])
+
+        for row in rows:
+            if group and (group[0][0] != row[0] or group[0][2] != row[2]):
+                flush(group)
+                group = []
+            group.append(list(row))
+        if group:
+            flush(group)
+        return changed
+
+    def _evict(self, series, since):
+        points = series["points"]
+        if not points or points[0][0] > since - self.evict_slack:
+            return False
+        while points and points[0][0] <= since:
+            _, names = points.popleft()
+            for name in names:
+                line = series["lines"][name]
+                line["x"].popleft()
+                line["y"].popleft()
+                line["text"].popleft()
+                if not line["x"]:
+                    del series["lines"][name]
+        return True
+
+    def refresh(self, conn):
+        since = self._since()
+        # one query for all swap types, every one of them from its own high-water
+        high_waters = {swap_type_id: series["high_water"] for swap_type_id, series in self.series.items()}
+        changed = self._append(get_data(conn, since, high_waters), since)
+        for swap_type_id, series in self.series.items():
+            if self._evict(series, since):
+                changed.add(swap_type_id)
+            series["high_water"] = max(series["high_water"], since)
+        for swap_type_id in changed:
+            self.series[swap_type_id]["traces"] = None
+        if changed:
+            self.page = None
+
+    def traces(self, swap_type_id):
+        series = self.series[swap_type_id]
+        if series["traces"] is None:
+            # same json as json.dumps of [{"x": [...], "y": [...], "mode": ..., "name": ..., "text": [...], "line": ...}]
+            traces = []
+            for name, line in series["lines"].items():
+                trace = '{"x": [%s], "y": [%s], "mode": "lines+markers", "name": %s, "text": [%s]' % (
+                    ", ".join(line["x"]), ", ".join(line["y"]), json.dumps(name), ", ".join(line["text"]))
                 if name in default_colors:
-                    aggreagators[name]["line"] = {"color": default_colors[name]}
-            
-            aggreagators[name]["x"].append(timepoint*1000)
-            aggreagators[name]["y"].append(x[8])
-            aggreagators[name]["text"].append(f"real_output: {x[3]}</br>loss_ratio: {x[4]}</br>gas_fees: {x[7]}</br>{convert_route(json.loads(x[5]))}")
-    
-    for name in aggreagators:
-        data.append(aggreagators[name])
+                    trace += ', "line": %s' % json.dumps({"color": default_colors[name]})
+                traces.append(trace + "}")
+            series["traces"] = "[%s]" % ", ".join(traces)
+        return series["traces"]
+
+    def render(self, conn):
+        """
+        Returns (page, gzipped page). While one thread rebuilds the page, others get the previous one instead of waiting
+        """
+        if not self.lock.acquire(blocking=self.served is None):
+            dashboard_renders.inc(result="stale")
+            return self.served
+        try:
+            self.refresh(conn)
+            dashboard_renders.inc(result="cached" if self.page is not None else "rebuilt")
+            if self.page is None:
+                panels = "".join(panel_template % {"id": swap_type_id, "title": swap_title(series["name"]), "data": self.traces(swap_type_id)}
+                                 for swap_type_id, series in sorted(self.series.items()) if series["points"])
+                page = (template % {"panels": panels}).encode()
+                # page is mostly json, so it is compressed once here instead of on every request
+                self.page = (page, gzip.compress(page, compresslevel=5))
+                self.served = self.page
+            return self.page
+        finally:
+            self.lock.release()
+
+
+placement_cache = PlacementCache()
+dashboard_renders = metrics.counter("dashboard_renders_total", "Dashboard requests by result: cached page, rebuilt page or stale page served during rebuild")
+
+
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "8"))
+MAX_RENDERS = int(os.getenv("MAX_RENDERS", "2"))
+# how long request waits for a render slot before we answer 503, in seconds
+RENDER_WAIT = float(os.getenv("RENDER_WAIT", "10"))
+# how many encoded API responses are kept
+API_CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", "64"))
+
+render_slots = threading.BoundedSemaphore(MAX_RENDERS)
+# routes measured separately, everything else is "static"
+ROUTES = ("/", "/metrics", "/api/swap_types", "/api/swaps")
+request_seconds = metrics.histogram("http_request_seconds", "Time to answer HTTP requests by route and status")
+api_cache_lookups = metrics.counter("api_cache_lookups_total", "Lookups of encoded /api/swaps responses by result")
+_local = threading.local()
+
+
+def get_connection():
+    """
+    Read-only connection of the current worker thread, opened on first use
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(f"file:{urllib.parse.quote(DB_PATH)}?mode=ro", uri=True)
+        _local.conn = conn
+    return conn
+
+
+def render_dashboard():
+    return placement_cache.render(get_connection())
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """
+    HTTPServer that hands accepted connections to fixed number of worker threads
+    """
+    # default backlog of 5 drops connections under load, and clients retry them only after a second
+    request_queue_size = 128
+
+    def __init__(self, address, handler, workers=SERVER_WORKERS):
+        super().__init__(address, handler)
+        self.requests = queue.Queue()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"http-worker-{i}", daemon=True).start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def encode_json(payload, gzipped):
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    if gzipped:
+        body = gzip.compress(body, compresslevel=5)
+    return body
+
+
+class ResponseCache:
+    """
+    Small LRU of encoded API responses keyed by (etag, gzipped), so clients without conditional requests
+    (or many clients asking the same range) don't make us rebuild and compress the same json
+    """
+    def __init__(self, capacity=API_CACHE_SIZE):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.bodies = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            body = self.bodies.get(key)
+            if body is not None:
+                self.bodies.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            self.bodies[key] = body
+            self.bodies.move_to_end(key)
+            while len(self.bodies) > self.capacity:
+                self.bodies.popitem(last=False)
+        return body
+
+
+api_responses = ResponseCache()
+
+
+def last_modified(utime):
+    return email.utils.formatdate(utime or 0, usegmt=True)
 
-    return json.dumps(data)
-    #return template % ()
 
 class MyHandler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
-        if self.path == "/":
+        url = urllib.parse.urlsplit(self.path)
+        self.status = None
+        started = time.perf_counter()
+        try:
+            self.route(url)
+        finally:
+            request_seconds.observe(time.perf_counter() - started, route=url.path if url.path in ROUTES else "static",
+                                    status=str(self.status))
+
+    def send_response(self, code, message=None):
+        # remembered for request_seconds
+        self.status = code
+        super().send_response(code, message)
+
+    def route(self, url):
+        if url.path == "/":
+            started = time.perf_counter()
+            if not render_slots.acquire(timeout=RENDER_WAIT):
+                self.send_busy()
+                return
+            try:
+                page, gzipped_page = render_dashboard()
+            finally:
+                render_slots.release()
+            elapsed = (time.perf_counter() - started) * 1000
+            gzipped = self.accepts_gzip()
+            if gzipped:
+                page = gzipped_page
             self.send_response(200)
             self.send_header("Content-type", "text/html")
+            self.send_header("Content-Length", str(len(page)))
+            self.send_header("Vary", "Accept-Encoding")
+            if gzipped:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Server-Timing", f"render;dur={elapsed:.1f}")
             self.end_headers()
-            USDT = "EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs"
-            ton = "ton"
-            RAFF = "EQCJbp0kBpPwPoBG-U5C-cWfP_jnksvotGfArPF50Q9Qiv9h"
-
-            data = {"1ton_usdt": get_graph(f"1 {ton}->{USDT}"),
-                    "100ton_usdt": get_graph(f"100 {ton}->{USDT}"),
-                    "10000ton_usdt": get_graph(f"10000 {ton}->{USDT}"),
-                    "1ton_raff": get_graph(f"1 {ton}->{RAFF}"),
-                    "100ton_raff": get_graph(f"100 {ton}->{RAFF}"),
-                    "10000ton_raff": get_graph(f"10000 {ton}->{RAFF}"),
-                    "1usdt_raff": get_graph(f"1 {USDT}->{RAFF}"),
-                    "100usdt_raff": get_graph(f"100 {USDT}->{RAFF}"),
-                    "10000usdt_raff": get_graph(f"10000 {USDT}->{RAFF}"),
-            }
-            self.wfile.write((template % data).encode())
-            #self.wfile.write(get_graph("1 ton->EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs").encode())
+            self.wfile.write(page)
+        elif url.path == "/metrics":
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-type", metrics.CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif url.path == "/api/swap_types":
+            self.send_json(get_swap_types(get_connection()))
+        elif url.path == "/api/swaps":
+            self.get_swaps(urllib.parse.parse_qs(url.query))
         else:
             super().do_GET()
 
-httpd = http.server.HTTPServer(('0.0.0.0', 8000), MyHandler)
-httpd.serve_forever()
+    def get_swaps(self, query):
+        now = int(time.time())
+        try:
+            swap_type = query["swap_type"][0]
+            end = int(query.get("to", [now])[0])
+            start = int(query.get("from", [end - int(WINDOW.total_seconds())])[0])
+            bucket = int(query.get("bucket", [0])[0])
+            if bucket < 0 or start > end:
+                raise ValueError("bad range")
+        except (KeyError, ValueError) as e:
+            self.send_json({"error": f"bad parameters: {e}"}, status=400)
+            return
+        conn = get_connection()
+        resolved = resolve_swap_type(conn, swap_type)
+        if resolved is None:
+            self.send_json({"error": "unknown swap_type"}, status=404)
+            return
+        swap_type_id, name = resolved
+        # etag depends only on rows in the range, not on the range itself (default one moves every second),
+        # so we can answer 304 before building anything
+        first_utime, last_utime, count = get_swaps_version(conn, swap_type_id, start, end)
+        etag = 'W/"%s"' % hashlib.sha1(f"{swap_type_id}:{bucket}:{first_utime}:{last_utime}:{count}".encode()).hexdigest()
+        if self.not_modified(etag, last_utime):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        gzipped = self.accepts_gzip()
+        body = api_responses.get((etag, gzipped))
+        api_cache_lookups.inc(result="miss" if body is None else "hit")
+        if body is None:
+            if not render_slots.acquire(timeout=RENDER_WAIT):
+                self.send_busy()
+                return
+            try:
+                response = get_swaps(conn, swap_type_id, start, end, bucket)
+            finally:
+                render_slots.release()
+            response.update({"swap_type": name, "bucket": bucket})
+            body = api_responses.put((etag, gzipped), encode_json(response, gzipped))
+        self.send_encoded_json(body, gzipped, etag=etag, modified=last_modified(last_utime))
+
+    def not_modified(self, etag, last_utime):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since and last_utime is not None:
+            try:
+                return email.utils.parsedate_to_datetime(if_modified_since).timestamp() >= last_utime
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_busy(self):
+        self.send_response(503)
+        self.send_header("Retry-After", "1")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def accepts_gzip(self):
+        return "gzip" in self.headers.get("Accept-Encoding", "")
+
+    def send_json(self, payload, status=200, etag=None, modified=None):
+        gzipped = self.accepts_gzip()
+        self.send_encoded_json(encode_json(payload, gzipped), gzipped, status, etag, modified)
+
+    def send_encoded_json(self, body, gzipped, status=200, etag=None, modified=None):
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Cache-Control", "no-cache")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        if etag:
+            self.send_header("ETag", etag)
+        if modified:
+            self.send_header("Last-Modified", modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+if __name__ == "__main__":
+    httpd = PooledHTTPServer(('0.0.0.0', SERVER_PORT), MyHandler)
+    httpd.serve_forever()
@@ -0,0 +1,163 @@
+"""
+Shared HTTP client layer.
+
+Opening aiohttp.ClientSession per request means a new TCP+TLS handshake every time,
+so instead we keep one long-lived session per upstream host (toncenter, swap.coffee, dedust, xdelta)
+with keep-alive connection pooling and DNS caching. Sessions are created lazily on first use
+inside the running event loop and should be closed with close_sessions() on shutdown.
+Every request is measured into upstream_request_seconds histogram (see metrics.py).
+
+Tuning through environment:
+    HTTP_LIMIT_PER_HOST     max simultaneous connections to one host (default 16)
+    HTTP_HOST_LIMITS        per-host overrides, e.g. "toncenter.com:8,backend.swap.coffee:4"
+    HTTP_DNS_CACHE_TTL      seconds to cache DNS resolution (default 300)
+    HTTP_KEEPALIVE_TIMEOUT  seconds to keep idle connections open (default 60)
+    HTTP_TIMEOUT            total timeout of one request in seconds (default 60)
+
+Upstream base urls are configurable, so the tester can run against the local replay server (see replay.py):
+    TONCENTER_URL, COFFEE_URL, DEDUST_URL, XDELTA_URL   base url of every upstream
+    REPLAY_URL              e.g. "http://127.0.0.1:8100", default for all of them becomes "<REPLAY_URL>/<upstream host>"
+    HTTP_RECORD_PATH        jsonl file, every successful response is appended there for replay.py
+"""
+
+import asyncio
+import json
+import os
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from metrics import histogram
+
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "16"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+
+
+def parse_host_limits(value):
+    # "host:limit,host:limit" -> {host: limit}
+    limits = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        host, limit = item.rsplit(":", 1)
+        limits[host.strip()] = int(limit)
+    return limits
+
+
+HOST_LIMITS = parse_host_limits(os.getenv("HTTP_HOST_LIMITS"))
+
+REPLAY_URL = os.getenv("REPLAY_URL")
+HTTP_RECORD_PATH = os.getenv("HTTP_RECORD_PATH")
+
+
+def upstream_url(name, default):
+    """
+    Base url of the upstream: from `name` environment variable, or replay server path of its host, or default
+    """
+    url = os.getenv(name)
+    if url:
+        return url.rstrip("/")
+    if REPLAY_URL:
+        return f"{REPLAY_URL.rstrip('/')}/{urlsplit(default).netloc}"
+    return default
+
+
+async def record_response(request, handler):
+    """
+    Client middleware of record mode: appends request and response to HTTP_RECORD_PATH.
+    The body is read here, so it has to be parsed from response.read()/json() afterwards, not streamed.
+    """
+    started = time.monotonic()
+    response = await handler(request)
+    body = await response.read()
+    if response.status != 200:
+        # errors and 429s are injected by replay.py, we only keep real answers
+        return response
+    request_body = await request.body.as_bytes() if request.body else b""
+    url = request.url
+    record = {
+        "method": request.method,
+        "host": url.host,
+        "path": url.path,
+        "query": url.query_string,
+        "request": request_body.decode("utf-8"),
+        "status": response.status,
+        "content_type": response.content_type,
+        "body": body.decode("utf-8"),
+        "elapsed": round(time.monotonic() - started, 4),
+    }
+    with open(HTTP_RECORD_PATH, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    return response
+
+
+upstream_seconds = histogram("upstream_request_seconds",
+                             "Time to response headers of upstream HTTP requests by host, path and status (error if no response)")
+
+
+async def _on_request_start(session, context, params):
+    context.started = time.monotonic()
+
+
+async def _on_request_end(session, context, params):
+    upstream_seconds.observe(time.monotonic() - context.started, upstream=params.url.host, endpoint=params.url.path,
+                             status=str(params.response.status))
+
+
+async def _on_request_exception(session, context, params):
+    if isinstance(params.exception, asyncio.CancelledError):
+        # e.g. the slower one of a hedged pair
+        status = "cancelled"
+    elif isinstance(params.exception, asyncio.TimeoutError):
+        status = "timeout"
+    else:
+        status = "error"
+    upstream_seconds.observe(time.monotonic() - context.started, upstream=params.url.host, endpoint=params.url.path, status=status)
+
+
+def upstream_trace():
+    # every request of every session is measured, including 429 retries and hedged duplicates
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(_on_request_start)
+    trace.on_request_end.append(_on_request_end)
+    trace.on_request_exception.append(_on_request_exception)
+    return trace
+
+
+_sessions = {}
+
+
+def get_session(url):
+    """
+    Returns pooled session for the host of given url, creating it on first use.
+    """
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=HOST_LIMITS.get(host, HTTP_LIMIT_PER_HOST),
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            use_dns_cache=True,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+        kwargs = {}
+        if HTTP_RECORD_PATH:
+            # client middlewares exist since aiohttp 3.12, older versions only can't record
+            kwargs["middlewares"] = (record_response,)
+        session = aiohttp.ClientSession(connector=connector,
+                                        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+                                        trace_configs=[upstream_trace()],
+                                        **kwargs)
+        _sessions[host] = session
+    return session
+
+
+async def close_sessions():
+    sessions = list(_sessions.values())
+    _sessions.clear()
+    for session in sessions:
+        if not session.closed:
+            await session.close()
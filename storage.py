@@ -0,0 +1,322 @@
+"""
+Persistence of swap results.
+
+We store data in SQLITE database:
+utime, aggregator, swap_type(what to what and amount), real_output, loss_ratio, short_descriptions_out, gas_fees
+then we want to retrieve data for prev 24 hours and given swap_type (see schema below)
+
+SwapWriter keeps one connection in WAL mode (so server readers never block the writer and vice versa)
+and owns a single thread where all SQLite work happens. Rows are handed over through asyncio queue,
+everything that piled up in the queue while the previous batch was written goes into one transaction,
+and old rows are pruned on separate schedule.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import counter, gauge, histogram
+
+DB_PATH = os.getenv("AGGREGATOR_DB", "aggregator.db")
+# how long we keep data, in seconds
+RETENTION = int(os.getenv("RETENTION", str(7 * 24 * 3600)))
+# how often old data is pruned, in seconds
+PRUNE_INTERVAL = float(os.getenv("PRUNE_INTERVAL", "3600"))
+
+
+def parse_swap_type(swap_type):
+    # "100 ton->EQCx..." -> ("ton", "EQCx...", 100)
+    amount, pair = swap_type.split(" ", 1)
+    input_token, output_token = pair.split("->", 1)
+    return input_token, output_token, float(amount)
+
+
+def format_swap_type(input_token, output_token, amount):
+    # amounts are stored as REAL, but swap types were always named with integer amounts when possible
+    if float(amount).is_integer():
+        amount = int(amount)
+    return f"{amount} {input_token}->{output_token}"
+
+
+"""
+Schema is versioned with PRAGMA user_version, MIGRATIONS[i] brings database from version i to i + 1.
+
+Version 0 is the original flat table:
+    swaps (utime, aggregator, swap_type, real_output, loss_ratio, short_descriptions_out, short_descriptions_in, gas_fees)
+where swap_type is long text like "100 ton->EQCx..." repeated in every row.
+
+Since version 1 pairs, amounts and aggregators live in small lookup tables, route descriptions are
+deduplicated into `routes`, and hot table `swap_results` is WITHOUT ROWID table clustered by
+(swap_type_id, utime, aggregator_id), so "swap type for last 24 hours" query is one range scan
+without touching anything else. `swaps` view keeps the old shape for readers.
+"""
+
+SCHEMA_1 = [
+    '''CREATE TABLE IF NOT EXISTS aggregators (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)''',
+    '''CREATE TABLE IF NOT EXISTS pairs (id INTEGER PRIMARY KEY, input_token TEXT NOT NULL, output_token TEXT NOT NULL,
+                                          UNIQUE (input_token, output_token))''',
+    '''CREATE TABLE IF NOT EXISTS amounts (id INTEGER PRIMARY KEY, amount REAL NOT NULL UNIQUE)''',
+    '''CREATE TABLE IF NOT EXISTS swap_types (id INTEGER PRIMARY KEY, pair_id INTEGER NOT NULL REFERENCES pairs,
+                                               amount_id INTEGER NOT NULL REFERENCES amounts, name TEXT NOT NULL UNIQUE,
+                                               UNIQUE (pair_id, amount_id))''',
+    '''CREATE TABLE IF NOT EXISTS routes (id INTEGER PRIMARY KEY, digest TEXT NOT NULL UNIQUE,
+                                           short_descriptions_out TEXT, short_descriptions_in TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS swap_results (utime INTEGER NOT NULL, swap_type_id INTEGER NOT NULL, aggregator_id INTEGER NOT NULL,
+                                                 real_output REAL, loss_ratio REAL, gas_fees REAL, route_id INTEGER,
+                                                 PRIMARY KEY (swap_type_id, utime, aggregator_id)) WITHOUT ROWID''',
+]
+
+SWAPS_VIEW_1 = '''CREATE VIEW swaps AS
+    SELECT r.utime, a.name AS aggregator, t.name AS swap_type, r.real_output, r.loss_ratio,
+           ro.short_descriptions_out, ro.short_descriptions_in, r.gas_fees
+    FROM swap_results r
+    JOIN swap_types t ON t.id = r.swap_type_id
+    JOIN aggregators a ON a.id = r.aggregator_id
+    LEFT JOIN routes ro ON ro.id = r.route_id'''
+
+
+def migrate_to_1(conn):
+    for statement in SCHEMA_1:
+        conn.execute(statement)
+    legacy = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'swaps'").fetchone()
+    if legacy:
+        ids = SchemaIds(conn)
+        rows = conn.execute("SELECT utime, aggregator, swap_type, real_output, loss_ratio, short_descriptions_out, short_descriptions_in, gas_fees FROM swaps")
+        for utime, aggregator, swap_type, real_output, loss_ratio, short_descriptions_out, short_descriptions_in, gas_fees in rows.fetchall():
+            conn.execute("INSERT OR REPLACE INTO swap_results VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                utime, ids.swap_type(*parse_swap_type(swap_type)), ids.aggregator(aggregator),
+                real_output, loss_ratio, gas_fees, ids.route(short_descriptions_out, short_descriptions_in)))
+        conn.execute("DROP TABLE swaps")
+    conn.execute(SWAPS_VIEW_1)
+
+
+"""
+Version 2 adds `status` of the measurement: "ok", or "timeout"/"error" when the aggregator or its emulation
+didn't finish in time. Failed rows have NULL real_output, loss_ratio, gas_fees and route, readers that rank
+aggregators skip rows with NULL loss_ratio.
+"""
+
+STATUS_OK = "ok"
+STATUS_TIMEOUT = "timeout"
+STATUS_ERROR = "error"
+
+SWAPS_VIEW_2 = '''CREATE VIEW swaps AS
+    SELECT r.utime, a.name AS aggregator, t.name AS swap_type, r.real_output, r.loss_ratio,
+           ro.short_descriptions_out, ro.short_descriptions_in, r.gas_fees, r.status
+    FROM swap_results r
+    JOIN swap_types t ON t.id = r.swap_type_id
+    JOIN aggregators a ON a.id = r.aggregator_id
+    LEFT JOIN routes ro ON ro.id = r.route_id'''
+
+
+def migrate_to_2(conn):
+    # existing rows get the default without rewriting the table
+    conn.execute(f"ALTER TABLE swap_results ADD COLUMN status TEXT NOT NULL DEFAULT '{STATUS_OK}'")
+    conn.execute("DROP VIEW swaps")
+    conn.execute(SWAPS_VIEW_2)
+
+
+"""
+Version 3 adds `price_utime`: utime of the price snapshot (see prices.py) the row was valued with,
+NULL for rows written before that.
+"""
+
+SWAPS_VIEW_3 = '''CREATE VIEW swaps AS
+    SELECT r.utime, a.name AS aggregator, t.name AS swap_type, r.real_output, r.loss_ratio,
+           ro.short_descriptions_out, ro.short_descriptions_in, r.gas_fees, r.status, r.price_utime
+    FROM swap_results r
+    JOIN swap_types t ON t.id = r.swap_type_id
+    JOIN aggregators a ON a.id = r.aggregator_id
+    LEFT JOIN routes ro ON ro.id = r.route_id'''
+
+
+def migrate_to_3(conn):
+    conn.execute("ALTER TABLE swap_results ADD COLUMN price_utime INTEGER")
+    conn.execute("DROP VIEW swaps")
+    conn.execute(SWAPS_VIEW_3)
+
+
+MIGRATIONS = [migrate_to_1, migrate_to_2, migrate_to_3]
+
+
+def create_database_if_not_exists(conn):
+    """
+    Creates or migrates schema to the latest version
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+    with conn:
+        conn.execute("BEGIN")
+        for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            print("Migrating database to schema version", target)
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+    if version == 0:
+        # give back space of the dropped flat table
+        conn.execute("VACUUM")
+
+
+class SchemaIds:
+    """
+    Resolves names of lookup tables into integer keys, remembering them so rows are written without extra selects
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.cache = {}
+
+    def _get_or_create(self, key, select, insert, params):
+        if key in self.cache:
+            return self.cache[key]
+        row = self.conn.execute(select, params).fetchone()
+        if row is None:
+            row_id = self.conn.execute(insert, params).lastrowid
+        else:
+            row_id = row[0]
+        self.cache[key] = row_id
+        return row_id
+
+    def aggregator(self, name):
+        return self._get_or_create(("aggregator", name), "SELECT id FROM aggregators WHERE name = ?",
+                                   "INSERT INTO aggregators (name) VALUES (?)", (name,))
+
+    def pair(self, input_token, output_token):
+        return self._get_or_create(("pair", input_token, output_token), "SELECT id FROM pairs WHERE input_token = ? AND output_token = ?",
+                                   "INSERT INTO pairs (input_token, output_token) VALUES (?, ?)", (input_token, output_token))
+
+    def amount(self, amount):
+        return self._get_or_create(("amount", float(amount)), "SELECT id FROM amounts WHERE amount = ?",
+                                   "INSERT INTO amounts (amount) VALUES (?)", (float(amount),))
+
+    def swap_type(self, input_token, output_token, amount):
+        name = format_swap_type(input_token, output_token, amount)
+        return self._get_or_create(("swap_type", name), "SELECT id FROM swap_types WHERE pair_id = ? AND amount_id = ? AND name = ?",
+                                   "INSERT INTO swap_types (pair_id, amount_id, name) VALUES (?, ?, ?)",
+                                   (self.pair(input_token, output_token), self.amount(amount), name))
+
+    def route(self, short_descriptions_out, short_descriptions_in):
+        # routes repeat a lot between sweeps, so they are stored once per distinct content
+        digest = hashlib.sha1(f"{short_descriptions_out}\n{short_descriptions_in}".encode()).hexdigest()
+        if ("route", digest) in self.cache:
+            return self.cache[("route", digest)]
+        row = self.conn.execute("SELECT id FROM routes WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            row_id = self.conn.execute("INSERT INTO routes (digest, short_descriptions_out, short_descriptions_in) VALUES (?, ?, ?)",
+                                       (digest, short_descriptions_out, short_descriptions_in)).lastrowid
+        else:
+            row_id = row[0]
+        self.cache[("route", digest)] = row_id
+        return row_id
+
+    def forget_routes(self):
+        for key in [key for key in self.cache if key[0] == "route"]:
+            del self.cache[key]
+
+
+class SwapWriter:
+    def __init__(self, path=DB_PATH, retention=RETENTION, prune_interval=PRUNE_INTERVAL):
+        self.path = path
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.conn = None
+        # one thread, so the connection is never used concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="swap-writer")
+        self.queue = asyncio.Queue()
+        self.tasks = []
+        # registered here and not on import: server.py imports this module too, and it never writes
+        self.rows_written = counter("rows_written_total", "Swap results committed to the database by status")
+        self.sqlite_seconds = histogram("sqlite_write_seconds", "Time of SQLite write transactions of SwapWriter by operation")
+        self.queue_depth = gauge("write_queue_depth", "Batches of rows waiting for SwapWriter")
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        create_database_if_not_exists(self.conn)
+        self.ids = SchemaIds(self.conn)
+
+    def _insert(self, rows):
+        started = time.monotonic()
+        try:
+            with self.conn:
+                ids = self.ids
+                self.conn.executemany("INSERT OR REPLACE INTO swap_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+                    (utime, ids.swap_type(*parse_swap_type(swap_type)), ids.aggregator(aggregator), real_output, loss_ratio, gas_fees,
+                     ids.route(json.dumps(short_descriptions_out), json.dumps(short_descriptions_in)) if status == STATUS_OK else None,
+                     status, price_utime)
+                    for utime, aggregator, swap_type, real_output, loss_ratio, short_descriptions_out, short_descriptions_in, gas_fees, status, price_utime in rows
+                ])
+        except Exception:
+            # ids created in the rolled back transaction don't exist anymore
+            self.ids = SchemaIds(self.conn)
+            raise
+        self.sqlite_seconds.observe(time.monotonic() - started, operation="insert")
+        for status, count in Counter(row[8] for row in rows).items():
+            self.rows_written.inc(count, status=status)
+
+    def _prune(self, utime):
+        started = time.monotonic()
+        with self.conn:
+            # per swap type, so every delete is a range scan of the primary key
+            for (swap_type_id,) in self.conn.execute("SELECT id FROM swap_types").fetchall():
+                self.conn.execute("DELETE FROM swap_results WHERE swap_type_id = ? AND utime < ?", (swap_type_id, utime))
+            self.conn.execute("DELETE FROM routes WHERE id NOT IN (SELECT route_id FROM swap_results WHERE route_id IS NOT NULL)")
+        self.ids.forget_routes()
+        self.sqlite_seconds.observe(time.monotonic() - started, operation="prune")
+
+    async def start(self):
+        await self._run(self._open)
+        self.tasks = [asyncio.create_task(self._write_loop()), asyncio.create_task(self._prune_loop())]
+
+    async def write(self, rows):
+        """
+        rows is a list of (utime, aggregator, swap_type, real_output, loss_ratio, short_descriptions_out, short_descriptions_in, gas_fees, status, price_utime),
+        they are written in one transaction
+        """
+        if rows:
+            await self.queue.put(list(rows))
+            self.queue_depth.set(self.queue.qsize())
+
+    async def _write_loop(self):
+        while True:
+            rows = await self.queue.get()
+            batches = 1
+            # everything that piled up while we were writing goes into the same transaction
+            while not self.queue.empty():
+                rows.extend(self.queue.get_nowait())
+                batches += 1
+            self.queue_depth.set(0)
+            try:
+                await self._run(self._insert, rows)
+            except Exception as e:
+                print("Error: failed to write", len(rows), "rows:", repr(e))
+            finally:
+                for _ in range(batches):
+                    self.queue.task_done()
+
+    async def _prune_loop(self):
+        while True:
+            try:
+                await self._run(self._prune, int(time.time()) - self.retention)
+            except Exception as e:
+                print("Error: failed to prune old rows:", repr(e))
+            await asyncio.sleep(self.prune_interval)
+
+    async def close(self):
+        # let queued rows land before closing the connection
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.conn is not None:
+            await self._run(self.conn.close)
+            self.conn = None
+        self.executor.shutdown()
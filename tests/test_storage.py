@@ -0,0 +1,102 @@
+"""
+Schema migrations of storage.py on databases in the original flat format.
+
+    python3 -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage import MIGRATIONS, STATUS_OK, create_database_if_not_exists
+
+USDT = "EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs"
+ROUTE_OUT = '[{"DEX": "stonfi_v2", "IN": "1000000000", "IN_ASSET_SHORT": "TON"}]'
+ROUTE_IN = '[{"DEX": "stonfi_v2", "OUT": "3500000", "OUT_ASSET_SHORT": "USD₮"}]'
+# what aggregator_tester wrote before schema versions existed
+LEGACY_ROWS = [
+    (1700000000, "Coffee.swap", f"1 ton->{USDT}", 3500000.0, 0.97, ROUTE_OUT, ROUTE_IN, 0.05),
+    (1700000000, "DeDust", f"1 ton->{USDT}", 3490000.0, 0.96, ROUTE_OUT, ROUTE_IN, 0.06),
+    (1700000060, "Coffee.swap", f"100 ton->{USDT}", 350000000.0, 0.98, ROUTE_OUT, "[]", 0.05),
+    (1700000060, "DeDust", f"100 ton->{USDT}", None, None, None, None, None),
+]
+TABLES = {"aggregators", "pairs", "amounts", "swap_types", "routes", "swap_results"}
+
+
+def migrate(conn):
+    # migrations report every step, that's not interesting here
+    with contextlib.redirect_stdout(io.StringIO()):
+        create_database_if_not_exists(conn)
+
+
+class LegacyMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "aggregator.db")
+        conn = sqlite3.connect(self.path)
+        conn.execute('''CREATE TABLE swaps (utime INTEGER, aggregator TEXT, swap_type TEXT, real_output REAL, loss_ratio REAL,
+                                            short_descriptions_out TEXT, short_descriptions_in TEXT, gas_fees REAL)''')
+        conn.executemany("INSERT INTO swaps VALUES (?, ?, ?, ?, ?, ?, ?, ?)", LEGACY_ROWS)
+        conn.commit()
+        conn.close()
+        self.conn = sqlite3.connect(self.path)
+
+    def tearDown(self):
+        self.conn.close()
+        self.directory.cleanup()
+
+    def objects(self):
+        return dict(self.conn.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view')").fetchall())
+
+    def swaps(self):
+        return self.conn.execute('''SELECT utime, aggregator, swap_type, real_output, loss_ratio, short_descriptions_out,
+                                           short_descriptions_in, gas_fees, status, price_utime
+                                    FROM swaps ORDER BY utime, aggregator''').fetchall()
+
+    def test_migrates_legacy_rows(self):
+        migrate(self.conn)
+        self.assertEqual(self.conn.execute("PRAGMA user_version").fetchone()[0], len(MIGRATIONS))
+        objects = self.objects()
+        self.assertTrue(TABLES <= {name for name, kind in objects.items() if kind == "table"})
+        # the flat table is gone, readers get a view of the same shape plus status and price_utime
+        self.assertEqual(objects["swaps"], "view")
+        self.assertEqual(self.swaps(), [row + (STATUS_OK, None) for row in LEGACY_ROWS])
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM swap_results").fetchone()[0], len(LEGACY_ROWS))
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM swap_types").fetchone()[0], 2)
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM pairs").fetchone()[0], 1)
+        # equal routes are stored once, rows without route too
+        self.assertEqual(self.conn.execute("SELECT count(*) FROM routes").fetchone()[0], 3)
+        # pages of the dropped table were given back by VACUUM
+        self.assertEqual(self.conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+
+    def test_migrating_twice_changes_nothing(self):
+        migrate(self.conn)
+        objects, swaps = self.objects(), self.swaps()
+        migrate(self.conn)
+        # a new connection too, as the server and the tester open their own
+        self.conn.close()
+        self.conn = sqlite3.connect(self.path)
+        migrate(self.conn)
+        self.assertEqual(self.conn.execute("PRAGMA user_version").fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(self.objects(), objects)
+        self.assertEqual(self.swaps(), swaps)
+
+
+class NewDatabaseTest(unittest.TestCase):
+    def test_creates_latest_schema(self):
+        conn = sqlite3.connect(":memory:")
+        migrate(conn)
+        migrate(conn)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(conn.execute("SELECT count(*) FROM swaps").fetchone()[0], 0)
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Persistent token metadata cache.
+
+Symbols and decimals of jettons practically never change, so we keep them in SQLite file
+and don't ask toncenter again after restart. In front of the file there is a bounded in-memory LRU.
+Every entry has expiration time: known tokens live for `ttl` seconds, negative results
+(token without metadata, that we show as "UNKWN" with 9 decimals) only for `negative_ttl`,
+after that they are treated as missing and get fetched again.
+
+Keys are raw uppercase addresses, e.g. "0:B113A994B5024A16719F69139328EB759596C38A25F59028B146FECDC3621DFE".
+"""
+
+import sqlite3
+import time
+from collections import OrderedDict
+
+from metrics import counter
+
+lookups_total = counter("token_cache_lookups_total", "Token metadata cache lookups by result: memory, disk, miss or expired")
+
+
+class TokenMetadataCache:
+    def __init__(self, path, capacity=4096, ttl=7 * 24 * 3600, negative_ttl=3600):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # address -> (symbol, decimals, expires_at)
+        self.memory = OrderedDict()
+        self.conn = None
+
+    def _connect(self):
+        # the file is opened lazily, so importing toncenter.py doesn't create it
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS token_metadata
+                                 (address TEXT PRIMARY KEY, symbol TEXT, decimals INTEGER, expires_at REAL)''')
+            self.conn.commit()
+        return self.conn
+
+    def _remember(self, address, entry):
+        self.memory[address] = entry
+        self.memory.move_to_end(address)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get(self, address):
+        """
+        Returns (symbol, decimals) or None if address is unknown or its entry expired
+        """
+        entry = self.memory.get(address)
+        result = "memory"
+        if entry is None:
+            row = self._connect().execute("SELECT symbol, decimals, expires_at FROM token_metadata WHERE address = ?",
+                                          (address,)).fetchone()
+            if row is None:
+                lookups_total.inc(result="miss")
+                return None
+            entry = tuple(row)
+            result = "disk"
+        if entry[2] < time.time():
+            self.memory.pop(address, None)
+            lookups_total.inc(result="expired")
+            return None
+        lookups_total.inc(result=result)
+        self._remember(address, entry)
+        return entry[0], entry[1]
+
+    def put_many(self, entries):
+        """
+        entries is a list of (address, symbol, decimals, negative), all of them are written in one transaction
+        """
+        now = time.time()
+        rows = []
+        for address, symbol, decimals, negative in entries:
+            entry = (symbol, decimals, now + (self.negative_ttl if negative else self.ttl))
+            self._remember(address, entry)
+            rows.append((address,) + entry)
+        conn = self._connect()
+        conn.executemany("INSERT OR REPLACE INTO token_metadata VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+
+    def put(self, address, symbol, decimals, negative=False):
+        self.put_many([(address, symbol, decimals, negative)])
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
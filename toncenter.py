@@ -1,30 +1,122 @@
-import aiohttp
 '''
 curl -X 'GET' \
   'https://toncenter.com/api/v3/walletStates?address=UQBGFBa0OAHi9jT1kq8PNy1OXW4CfMJkPAl4wQsP2gNJWkpJ' \
   -H 'accept: application/json'
 '''
 # load api key from environment
+import asyncio
+import hashlib
 import os
-from pytoniq_core.boc.address import Address
+import time
+from collections import OrderedDict
+from addresses import NATIVE, canonical_address, is_native
+from sessions import get_session, upstream_url, HTTP_RECORD_PATH
+from rate_limiter import RateLimiter, PRIORITY_EMULATE, PRIORITY_CHAIN_STATE, PRIORITY_METADATA, PRIORITY_NAMES
+from token_cache import TokenMetadataCache
+from metrics import counter, histogram
+try:
+    # optional, used for streaming parsing of emulation responses
+    import ijson
+except ImportError:
+    ijson = None
 toncenter_api_key = os.getenv("TONCENTER_API_KEY")
+TONCENTER_URL = upstream_url("TONCENTER_URL", "https://toncenter.com")
+
+# all toncenter endpoints share one quota of the api key, so every request goes through one limiter.
+# keyless access is limited to 1 rps, default key plan to 10 rps
+TONCENTER_RPS = float(os.getenv("TONCENTER_RPS", "10" if toncenter_api_key else "1"))
+TONCENTER_BURST = int(os.getenv("TONCENTER_BURST", "1"))
+TONCENTER_MAX_RETRIES = int(os.getenv("TONCENTER_MAX_RETRIES", "5"))
+toncenter_limiter = RateLimiter(TONCENTER_RPS, TONCENTER_BURST)
+limiter_wait_seconds = histogram("toncenter_limiter_wait_seconds", "Time toncenter requests waited for the rate limiter by priority")
+
+async def read_json(response):
+    return await response.json()
+
+async def toncenter_request(method, url, priority, parse=read_json, **kwargs):
+    # add api key to headers
+    headers = { "accept": "application/json" }
+    if toncenter_api_key:
+        headers["X-API-Key"] = toncenter_api_key
+    for attempt in range(TONCENTER_MAX_RETRIES + 1):
+        started = time.monotonic()
+        await toncenter_limiter.acquire(priority)
+        limiter_wait_seconds.observe(time.monotonic() - started, priority=PRIORITY_NAMES.get(priority, str(priority)))
+        async with get_session(url).request(method, url, headers = headers, **kwargs) as response:
+            if response.status == 429:
+                try:
+                    retry_after = float(response.headers["Retry-After"])
+                except (KeyError, ValueError):
+                    retry_after = None
+                toncenter_limiter.backoff(retry_after)
+                if attempt < TONCENTER_MAX_RETRIES:
+                    continue
+            # error bodies are not data: callers would fail later on a missing key, far from the cause
+            response.raise_for_status()
+            toncenter_limiter.success()
+            return await parse(response)
 
 async def get_mc_seq_no():
-   # add api key to headers
-    headers = { "accept": "application/json", "X-API-Key": toncenter_api_key }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"https://toncenter.com/api/v2/getMasterchainInfo", headers = headers) as response:
-            resp = await response.json()
-            return resp["result"]["last"]["seqno"]
+    resp = await toncenter_request("GET", f"{TONCENTER_URL}/api/v2/getMasterchainInfo", PRIORITY_CHAIN_STATE)
+    return resp["result"]["last"]["seqno"]
 
 
 async def get_wallet_seqno(address):
-    # add api key to headers
-    headers = { "accept": "application/json", "X-API-Key": toncenter_api_key }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"https://toncenter.com/api/v3/walletStates?address={address}", headers = headers) as response:
-            wallet = await response.json()
-            return wallet["wallets"][0]["seqno"]
+    wallet = await toncenter_request("GET", f"{TONCENTER_URL}/api/v3/walletStates?address={address}", PRIORITY_CHAIN_STATE)
+    return wallet["wallets"][0]["seqno"]
+
+
+"""
+Chain state changes slowly compared to how often we ask for it: masterchain seqno moves once per block (~5s),
+and seqno of the sender wallet practically never, since the wallet never actually sends anything.
+ChainStateCache keeps every field for its own TTL, concurrent callers share one in-flight request,
+and refresh() drops fields explicitly, e.g. when emulations start failing because the wallet seqno moved.
+"""
+# seconds, about one masterchain block
+MC_SEQNO_TTL = float(os.getenv("MC_SEQNO_TTL", "5"))
+WALLET_SEQNO_TTL = float(os.getenv("WALLET_SEQNO_TTL", "600"))
+
+
+class ChainStateCache:
+    def __init__(self, mc_seqno_ttl=MC_SEQNO_TTL, wallet_seqno_ttl=WALLET_SEQNO_TTL):
+        self.ttls = {"mc_seq_no": mc_seqno_ttl, "wallet_seqno": wallet_seqno_ttl}
+        # (field, address or None) -> (value, expires_at)
+        self.entries = {}
+        # (field, address or None) -> in-flight task
+        self.requests = {}
+
+    def _store(self, key, task):
+        self.requests.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.entries[key] = (task.result(), time.monotonic() + self.ttls[key[0]])
+
+    async def _get(self, key, fetch):
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        task = self.requests.get(key)
+        if task is None:
+            task = self.requests[key] = asyncio.ensure_future(fetch())
+            task.add_done_callback(lambda task: self._store(key, task))
+        # one cancelled caller must not cancel the request of the others
+        return await asyncio.shield(task)
+
+    async def mc_seq_no(self):
+        return await self._get(("mc_seq_no", None), get_mc_seq_no)
+
+    async def wallet_seqno(self, address):
+        return await self._get(("wallet_seqno", address), lambda: get_wallet_seqno(address))
+
+    def refresh(self, *fields):
+        """
+        Drops cached values of given fields ("mc_seq_no", "wallet_seqno"), or of all fields, so the next call fetches them
+        """
+        for key in list(self.entries):
+            if not fields or key[0] in fields:
+                del self.entries[key]
+
+
+chain_state = ChainStateCache()
 
 """
  toncenter emulation works as follows:
@@ -37,19 +129,167 @@ async def get_wallet_seqno(address):
 and returns emulation result
 """
 
-async def emulate(mc_seq_no, boc):
-    async with aiohttp.ClientSession() as session:
-        emulation_request = {
-            "boc": boc.decode("utf-8"),
-            "mc_block_seqno": mc_seq_no,
-            "ignore_chksig": True,
-            "include_code_data": False,
-            "with_actions": True
-        }
-        headers = { "accept": "application/json", "X-API-Key": toncenter_api_key }
-        async with session.post("https://toncenter.com/api/emulate/v1/emulateTrace", json=emulation_request, headers = headers) as response:
-            emulation = await response.json()
+"""
+emulateTrace response contains every account state and transaction of the trace, but assess_emulation
+only needs sender balances and lts, actions and the shape of the trace. With EMULATION_STREAMING=1
+(requires ijson) the response is parsed incrementally from the network stream and only these fields are kept,
+so we never hold the full object tree of big multi-hop emulations in memory.
+"""
+EMULATION_STREAMING = os.getenv("EMULATION_STREAMING", "0") == "1"
+if EMULATION_STREAMING and ijson is None:
+    print("Warning: EMULATION_STREAMING requires ijson package, falling back to full json parsing")
+
+# actions that assess_emulation looks into, other actions are reduced to their type
+ASSESSED_ACTIONS = ("jetton_swap", "jetton_transfer")
+SCALAR_EVENTS = ("string", "number", "boolean", "null")
+TRANSACTION_FIELDS = (".account", ".lt", ".balance")
+EMULATION_STREAM_BUFFER = 16 * 1024
+
+async def parse_emulation_stream(stream):
+    """
+    Builds pruned emulation from async stream (anything with `async read(n)`):
+    {
+        "transactions": {"hash": {"account": A, "lt": L, "account_state_before": {"balance": X}, "account_state_after": {"balance": Y}}},
+        "trace": {...},
+        "actions": [...],
+        + top-level scalar fields, e.g. "error"
+    }
+    """
+    emulation = {}
+    builder = None
+    # small buffer: ijson turns every chunk into a list of events before yielding them
+    async for prefix, event, value in ijson.parse_async(stream, buf_size=EMULATION_STREAM_BUFFER, use_float=True):
+        if builder is not None:
+            # we are inside actions item or trace, they are kept as is
+            builder.event(event, value)
+            if prefix == builder_prefix and event in ("end_map", "end_array"):
+                if builder_prefix == "trace":
+                    emulation["trace"] = builder.value
+                elif builder.value.get("type") in ASSESSED_ACTIONS:
+                    emulation["actions"].append(builder.value)
+                else:
+                    emulation["actions"].append({"type": builder.value.get("type")})
+                builder = None
+            continue
+        if prefix.startswith("transactions."):
+            # most of the events are here, so cheap suffix check goes first
+            if prefix.endswith(TRANSACTION_FIELDS) and event in SCALAR_EVENTS:
+                path = prefix.split(".")
+                if len(path) == 3:
+                    emulation["transactions"].setdefault(path[1], {})[path[2]] = value
+                elif len(path) == 4 and path[2] in ("account_state_before", "account_state_after"):
+                    emulation["transactions"].setdefault(path[1], {})[path[2]] = {"balance": value}
+            continue
+        if (prefix == "actions.item" or prefix == "trace") and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder_prefix = prefix
+            builder.event(event, value)
+        elif prefix == "actions" and event == "start_array":
+            emulation["actions"] = []
+        elif prefix == "transactions" and event == "start_map":
+            emulation["transactions"] = {}
+        elif prefix and "." not in prefix and event in SCALAR_EVENTS:
+            emulation[prefix] = value
+    return emulation
+
+async def read_emulation_stream(response):
+    return await parse_emulation_stream(response.content)
+
+async def fetch_emulation(mc_seq_no, boc, streaming=EMULATION_STREAMING):
+    emulation_request = {
+        "boc": boc.decode("utf-8"),
+        "mc_block_seqno": mc_seq_no,
+        "ignore_chksig": True,
+        "include_code_data": False,
+        "with_actions": True
+    }
+    # record mode reads the whole body to save it, there is nothing left to stream
+    parse = read_emulation_stream if streaming and ijson is not None and not HTTP_RECORD_PATH else read_json
+    emulation = await toncenter_request("POST", f"{TONCENTER_URL}/api/emulate/v1/emulateTrace", PRIORITY_EMULATE, parse=parse, json=emulation_request)
+    return emulation
+
+
+"""
+Emulation result depends only on the external message and the block it is emulated against, and emulations are
+what toncenter quota is mostly spent on. Byte-identical externals are common: both aggregators return the same
+single-hop route, or a route didn't change between sweeps of the same block (emulation messages of one minute
+share valid_until, see messages.py). So results are kept by (sha256 of BOC, mc seqno) in LRU of EMULATION_CACHE_SIZE
+entries (0 disables it), and concurrent requests of the same key share one in-flight call. Hedged attempts
+(see deadlines.py) are the exception: they are started because that call is slow, so they send their own request,
+and whichever answers first is cached. Block seqno only goes up, so entries of older blocks can't be hit again:
+they are dropped as soon as an emulation of a newer block is asked for, and the cache holds about one block.
+Cached emulations are shared between jobs, so they must be treated as read-only.
+"""
+EMULATION_CACHE_SIZE = int(os.getenv("EMULATION_CACHE_SIZE", "128"))
+emulation_cache_lookups = counter("emulation_cache_lookups_total", "Emulation cache lookups by result: hit, shared in-flight call, miss or hedge")
+
+
+class EmulationCache:
+    def __init__(self, capacity=EMULATION_CACHE_SIZE):
+        self.capacity = capacity
+        # (boc hash, mc seqno) -> emulation
+        self.entries = OrderedDict()
+        # (boc hash, mc seqno) -> in-flight task
+        self.requests = {}
+        # newest mc seqno we were asked about
+        self.mc_seq_no = None
+
+    def _new_block(self, mc_seq_no):
+        if self.mc_seq_no is not None and mc_seq_no <= self.mc_seq_no:
+            return
+        self.mc_seq_no = mc_seq_no
+        for key in [key for key in self.entries if key[1] < mc_seq_no]:
+            del self.entries[key]
+
+    def _put(self, key, emulation):
+        # answers without transactions are errors of the emulator, we ask again next time;
+        # emulations of a block that is already behind finished late, nobody will ask for them again
+        if isinstance(emulation, dict) and "transactions" in emulation and key[1] >= self.mc_seq_no:
+            self.entries[key] = emulation
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def _store(self, key, task):
+        self.requests.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._put(key, task.result())
+
+    async def get(self, mc_seq_no, boc, fetch, hedge=False):
+        if self.capacity <= 0:
+            return await fetch()
+        self._new_block(mc_seq_no)
+        key = (hashlib.sha256(boc).digest(), mc_seq_no)
+        emulation = self.entries.get(key)
+        if emulation is not None:
+            self.entries.move_to_end(key)
+            emulation_cache_lookups.inc(result="hit")
+            return emulation
+        if hedge:
+            # waiting for the in-flight call would make the hedge pointless
+            emulation_cache_lookups.inc(result="hedge")
+            emulation = await fetch()
+            self._put(key, emulation)
             return emulation
+        task = self.requests.get(key)
+        if task is None:
+            emulation_cache_lookups.inc(result="miss")
+            task = self.requests[key] = asyncio.ensure_future(fetch())
+            task.add_done_callback(lambda task: self._store(key, task))
+        else:
+            emulation_cache_lookups.inc(result="shared")
+        # one caller running out of budget must not cancel the emulation the others wait for
+        return await asyncio.shield(task)
+
+
+emulation_cache = EmulationCache()
+
+
+async def emulate(mc_seq_no, boc, streaming=EMULATION_STREAMING, hedge=False):
+    """
+    hedge=True is for hedged attempts: the cache is still checked, but an in-flight call of the same emulation isn't shared
+    """
+    return await emulation_cache.get(mc_seq_no, boc, lambda: fetch_emulation(mc_seq_no, boc, streaming), hedge)
 
 
 
@@ -74,45 +314,93 @@ curl -X 'GET' \
   }
 }
 
+The endpoint accepts multiple `address` query parameters and returns all of them in one response,
+so instead of asking for every token separately we collect all unknown addresses and resolve them
+in batches of METADATA_BATCH_SIZE, filling both symbol and decimals caches at once.
+
 we want to get token symbol for given address, but we also want to agrssively cache it via cache
 """
 
-token_symbol_cache = {}
+METADATA_BATCH_SIZE = int(os.getenv("METADATA_BATCH_SIZE", "100"))
 
-async def get_token_symbol(address):
-    if address in token_symbol_cache:
-        return token_symbol_cache[address]
-    headers = { "accept": "application/json", "X-API-Key": toncenter_api_key }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"https://toncenter.com/api/v3/metadata?address={address}", headers = headers) as response:
-            metadata = await response.json()
-            try:
-              symbol = metadata[address]["token_info"][0]["symbol"]
-            except:
-                if address is None:
-                    symbol = "TON"
-                else:
-                  symbol = "UNKWN"
-            token_symbol_cache[address] = symbol
-            return symbol
+# symbols and decimals are cached together by raw address, in memory and on disk (see token_cache.py)
+token_metadata_cache = TokenMetadataCache(
+    os.getenv("TOKEN_CACHE_PATH", "token_metadata.db"),
+    capacity = int(os.getenv("TOKEN_CACHE_SIZE", "4096")),
+    ttl = float(os.getenv("TOKEN_CACHE_TTL", str(7 * 24 * 3600))),
+    negative_ttl = float(os.getenv("TOKEN_CACHE_NEGATIVE_TTL", "3600")),
+)
+# address -> task of the batch request that is currently resolving it
+_metadata_requests = {}
+
+async def fetch_token_metadata(addresses):
+    params = [("address", address) for address in addresses]
+    metadata = await toncenter_request("GET", f"{TONCENTER_URL}/api/v3/metadata", PRIORITY_METADATA, params=params)
+    entries = []
+    for address in addresses:
+        try:
+            token_info = metadata[address]["token_info"][0]
+        except:
+            # no metadata, this negative result is cached for shorter time
+            entries.append((address, "UNKWN", 9, True))
+            continue
+        try:
+          decimals = int(token_info["extra"]["decimals"])
+        except:
+            decimals = 9
+        entries.append((address, token_info.get("symbol") or "UNKWN", decimals, False))
+    token_metadata_cache.put_many(entries)
+
+async def prefetch_token_metadata(addresses):
+    """
+    Makes sure that symbols and decimals of all given addresses are cached.
+    Unknown addresses are resolved with as few requests as possible, addresses that are already
+    being resolved by another coroutine are awaited instead of requested again.
+    """
+    wanted = set()
+    for address in addresses:
+        # keys of /api/v3/metadata response are canonical raw addresses too
+        address = canonical_address(address)
+        if address == NATIVE:
+            continue
+        if token_metadata_cache.get(address) is None:
+            wanted.add(address)
+    tasks = {_metadata_requests[address] for address in wanted if address in _metadata_requests}
+    missing = [address for address in wanted if address not in _metadata_requests]
+    for i in range(0, len(missing), METADATA_BATCH_SIZE):
+        batch = missing[i:i + METADATA_BATCH_SIZE]
+        task = asyncio.ensure_future(fetch_token_metadata(batch))
+        for address in batch:
+            _metadata_requests[address] = task
+        task.add_done_callback(lambda _, batch=batch: _forget_metadata_requests(batch))
+        tasks.add(task)
+    if tasks:
+        # asyncio.wait doesn't cancel batch requests if we are cancelled, other waiters may still need them
+        await asyncio.wait(tasks)
+        for task in tasks:
+            task.result()
 
-token_decimals_cache = {}
+def _forget_metadata_requests(addresses):
+    for address in addresses:
+        _metadata_requests.pop(address, None)
+
+async def get_token_metadata(address):
+    """
+    Returns (symbol, decimals) of the token
+    """
+    address = canonical_address(address)
+    metadata = token_metadata_cache.get(address)
+    if metadata is None:
+        await prefetch_token_metadata([address])
+        metadata = token_metadata_cache.get(address)
+    return metadata
+
+async def get_token_symbol(address):
+    if is_native(address):
+        return "TON"
+    return (await get_token_metadata(address))[0]
 
 async def get_token_decimals(address):
-    if address == "ton":
+    if is_native(address):
         return 9
-    # The keys of /api/v3/metadata response are raw addresses with uppercase letters,
-    # so we convert the input address to have this format.
-    address = Address(address).to_str(is_user_friendly=False).upper()
-    if address in token_decimals_cache:
-        return token_decimals_cache[address]
-    headers = { "accept": "application/json", "X-API-Key": toncenter_api_key }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"https://toncenter.com/api/v3/metadata?address={address}", headers = headers) as response:
-            metadata = await response.json()
-            try:
-              decimals = int(metadata[address]["token_info"][0]["extra"]["decimals"])
-            except:
-                decimals = 9
-            token_decimals_cache[address] = decimals
-            return decimals
+    return (await get_token_metadata(address))[1]